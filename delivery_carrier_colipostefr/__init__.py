@@ -9,8 +9,11 @@
 ##############################################################################
 
 from . import company
+from . import controllers
 from . import config
 from . import deposit_slip
+from . import sequence
 from . import stock
 from . import stock_transfer
 from . import file_document
+from . import label_store
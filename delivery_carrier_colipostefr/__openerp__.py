@@ -68,9 +68,12 @@ Contributors
     'data': [
         'data/delivery.xml',
         'data/file_repository.xml',
+        'data/label_store.xml',
+        'security/ir.model.access.csv',
         'config_view.xml',
         'stock_view.xml',
-        'deposit_view.xml'
+        'deposit_view.xml',
+        'sequence_view.xml',
     ],
     'demo': [
         'demo/res.partner.csv',
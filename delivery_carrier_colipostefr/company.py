@@ -55,6 +55,11 @@ class ResCompany(orm.Model):
             help="Pour ColiPoste International. \nSi coché, un commentaire "
                  "sera créé dans le bon de livraison\nsi la réponse du "
                  "web service contient un message additionnel."),
+        'colipostefr_ws_concurrency': fields.integer(
+            'Appels simultanés au Webservice',
+            help="Pour ColiPoste International.\nNombre maximum d'étiquettes "
+                 "demandées en parallèle au web service pour ce compte.\n"
+                 "1 : les colis sont traités les uns après les autres."),
         'colipostefr_repo_task_id': fields.many2one(
             'repository.task',
             string="Tâche EDI",
@@ -73,4 +78,13 @@ class ResCompany(orm.Model):
         'colipostefr_password': '',
         'colipostefr_unittest_helper': False,
         'colipostefr_webservice_message': True,
+        'colipostefr_ws_concurrency': 1,
     }
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ResCompany, self).write(cr, uid, ids, vals,
+                                            context=context)
+        if any(key.startswith('colipostefr_') for key in vals):
+            picking_obj = self.pool['stock.picking']
+            picking_obj._get_cached_postefr_service.clear_cache(picking_obj)
+        return res
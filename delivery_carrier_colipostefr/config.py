@@ -82,6 +82,14 @@ class ColiposteFrConfigSettings(orm.TransientModel):
             help="Pour ColiPoste International. \nSi coché, un commentaire "
                  "sera créé dans le bon de livraison\nsi la réponse du "
                  "web service contient un message additionnel."),
+        'ws_concurrency': fields.related(
+            'company_id', 'colipostefr_ws_concurrency',
+            string='Appels simultanés au Webservice',
+            relation='res.company',
+            type='integer',
+            help="Pour ColiPoste International.\nNombre maximum d'étiquettes "
+                 "demandées en parallèle au web service pour ce compte.\n"
+                 "1 : les colis sont traités les uns après les autres."),
         'repo_task_id': fields.related(
             'company_id', 'colipostefr_repo_task_id',
             string='Tâche EDI',
@@ -114,7 +122,7 @@ class ColiposteFrConfigSettings(orm.TransientModel):
             cr, uid, company_id, context=context)
         fields = ['account', 'world_account', 'support_city',
                   'support_city_code', 'password', 'webservice_message',
-                  'unittest_helper', 'repo_task_id']
+                  'unittest_helper', 'repo_task_id', 'ws_concurrency']
         for field in fields:
             cpny_field = 'colipostefr_%s' % field
             values[field] = company[cpny_field]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+from openerp import http
+from openerp.http import request
+from openerp.tools.config import config
+
+from . import metrics
+
+
+class ColipostefrMetrics(http.Controller):
+
+    @http.route('/colipostefr/metrics', type='http', auth='none')
+    def metrics(self, **kwargs):
+        """ Metrics of the worker in the Prometheus text format,
+            only when the server option 'colipostefr_metrics_endpoint'
+            is set
+        """
+        if not config.get('colipostefr_metrics_endpoint'):
+            return request.not_found()
+        body = metrics.REGISTRY.render()
+        return request.make_response(
+            body.encode('utf-8'),
+            [('Content-Type', 'text/plain; version=0.0.4')])
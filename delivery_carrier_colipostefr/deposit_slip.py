@@ -8,37 +8,85 @@
 #
 ##############################################################################
 
-from openerp.osv import orm
+import openerp
+from openerp import api
+from openerp.osv import orm, fields
+from openerp.tools.config import config
 from openerp.tools.translate import _
 from openerp.tools.misc import DEFAULT_SERVER_DATETIME_FORMAT as serv_date_format
 from datetime import datetime
-import unicodecsv
 from cStringIO import StringIO
-from csv import Dialect
-from _csv import QUOTE_MINIMAL, register_dialect
+from _csv import register_dialect
+from multiprocessing.pool import ThreadPool
+from tempfile import NamedTemporaryFile, TemporaryFile
 import base64
-from openerp.tools import misc
+import hashlib
+import logging
+import os
+import threading
+from openerp.tools import misc, ustr
+
+from .edi_writer import LaposteDialect, HEADER_ENCODER, LINE_ENCODER
+from . import metrics
+
+_logger = logging.getLogger(__name__)
 
 # This code is used by Colissimo and So Colissimo
 # TODO this code is not fully updated for So Colissimo
 # coorection will be firstly defined in v7 branch
 
 
-class LaposteDialect(Dialect):
-    """Describe the usual properties of Excel-generated CSV files."""
-    delimiter = ';'
-    quotechar = '"'
-    escapechar = '\\'
-    doublequote = False
-    skipinitialspace = False
-    lineterminator = '\r\n'
-    quoting = QUOTE_MINIMAL
 register_dialect("laposte_dialect", LaposteDialect)
 
+# base64.encodestring() encodes 57 bytes per line: encoding chunks of
+# a multiple of 57 bytes gives the same result as encoding the whole file
+BASE64_CHUNK_SIZE = 57 * 1024
+
+# histogram buckets of the EDI files
+EDI_ROWS = (10, 50, 100, 500, 1000, 5000, 10000, 50000)
+EDI_BYTES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8)
+
+
+def encodestring_file(input_file, output_file, chunk_size=BASE64_CHUNK_SIZE):
+    """ Write base64.encodestring() of input_file to output_file
+        without loading the whole input in memory
+    """
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        output_file.write(base64.encodestring(chunk))
+
+
+class HashingFile(object):
+    """ Write to a file, computing its sha1 and size on the way """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.sha = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        self.output_file.write(data)
+
 
 class DepositSlip(orm.Model):
     _inherit = "deposit.slip"
 
+    _columns = {
+        'colipostefr_edi_export_count': fields.integer(
+            'EDI Exports',
+            readonly=True,
+            help="Number of EDI files sent for this deposit: the packages "
+                 "are marked with the number of the file which sent them"),
+    }
+
+    _defaults = {
+        'colipostefr_edi_export_count': 0,
+    }
+
     def create_header_vals(self, cr, uid, deposit, context=None):
         company = deposit.picking_ids[0].company_id
         create_date = datetime.strptime(deposit.create_date,
@@ -78,103 +126,198 @@ class DepositSlip(orm.Model):
         else:
             return ''
 
-    def create_edi_lines(self, cr, uid, deposit, context=None):
-        lines = []
-        for picking in deposit.picking_ids:
-            if picking.carrier_code not in ['EI', 'AI']:
-                address = picking.partner_id
-                # TODO So Colissimo see correction in V7 branch
-                # dropoff_site = picking.dropoff_site_id
-                non_machi = "N"
-                # TODO
-                # if picking.non_machinable:
-                #     non_machi = "O"
-                dropoff_code = None
+    def create_edi_lines(self, cr, uid, deposit, snapshot=None,
+                         context=None):
+        """ EDI lines of the deposit, generated one by one
+
+        :param snapshot: result of _read_edi_snapshot(), read if missing
+        :return: iterator of dicts
+        """
+        return self._iter_edi_lines(
+            cr, uid, deposit, snapshot=snapshot, context=context)
+
+    def _read_edi_snapshot(self, cr, uid, deposit, delta=False,
+                           context=None):
+        """ Read with a few set-based queries what the EDI lines need
+            about the pickings of the deposit, their partners (title,
+            country) and their packages
+
+        :param delta: only keep the packages not exported yet
+                      and the pickings having such packages
+
+        :return: list of (picking, address, packages), where picking is
+                 a browse record and address and packages are dicts
+        """
+        picking_obj = self.pool['stock.picking']
+        partner_obj = self.pool['res.partner']
+        op_obj = self.pool['stock.pack.operation']
+        picking_ids = [picking.id for picking in deposit.picking_ids]
+        pickings = picking_obj.read(
+            cr, uid, picking_ids, ['carrier_code', 'partner_id'],
+            context=context, load='_classic_write')
+        picking_ids = [pick['id'] for pick in pickings
+                       if pick['carrier_code'] not in ['EI', 'AI']]
+        edi_picking_ids = set(picking_ids)
+        partner_ids = list(set(pick['partner_id'] for pick in pickings
+                               if pick['id'] in edi_picking_ids))
+        partners = partner_obj.read(
+            cr, uid, partner_ids, ['name', 'title', 'phone', 'mobile',
+                                   'email', 'zip', 'city', 'street',
+                                   'country_id'],
+            context=context, load='_classic_write')
+        titles = dict(
+            (title['id'], title['shortcut'])
+            for title in self.pool['res.partner.title'].read(
+                cr, uid, list(set(partner['title'] for partner in partners
+                                  if partner['title'])),
+                ['shortcut'], context=context))
+        countries = dict(
+            (country['id'], country['code'])
+            for country in self.pool['res.country'].read(
+                cr, uid, list(set(partner['country_id']
+                                  for partner in partners
+                                  if partner['country_id'])),
+                ['code'], context=context))
+        addresses = {}
+        for partner in partners:
+            partner['title'] = titles.get(partner['title'])
+            partner['country_code'] = countries.get(partner['country_id'])
+            addresses[partner['id']] = partner
+        op_ids = op_obj.search(
+            cr, uid, [('picking_id', 'in', picking_ids),
+                      ('result_package_id', '!=', False)],
+            order='id', context=context)
+        package_ids_by_picking = dict((pick_id, []) for pick_id in picking_ids)
+        all_package_ids = set()
+        for op in op_obj.read(cr, uid, op_ids,
+                              ['picking_id', 'result_package_id'],
+                              context=context, load='_classic_write'):
+            package_ids = package_ids_by_picking[op['picking_id']]
+            if op['result_package_id'] not in package_ids:
+                package_ids.append(op['result_package_id'])
+                all_package_ids.add(op['result_package_id'])
+        packages = dict(
+            (package['id'], package)
+            for package in self.pool['stock.quant.package'].read(
+                cr, uid, list(all_package_ids),
+                ['parcel_tracking', 'weight', 'colipostefr_edi_export'],
+                context=context))
+        if delta:
+            for package_ids in package_ids_by_picking.values():
+                package_ids[:] = [
+                    package_id for package_id in package_ids
+                    if not packages[package_id]['colipostefr_edi_export']]
+            picking_ids = [pick_id for pick_id in picking_ids
+                           if package_ids_by_picking[pick_id]]
+        partner_by_picking = dict((pick['id'], pick['partner_id'])
+                                  for pick in pickings)
+        snapshot = []
+        for picking in picking_obj.browse(
+                cr, uid, picking_ids, context=context):
+            snapshot.append((
+                picking,
+                addresses[partner_by_picking[picking.id]],
+                [packages[package_id]
+                 for package_id in package_ids_by_picking[picking.id]]))
+        return snapshot
+
+    def _iter_edi_lines(self, cr, uid, deposit, snapshot=None,
+                        context=None):
+        """ Generate the EDI lines one by one """
+        partner_obj = self.pool['res.partner']
+        if snapshot is None:
+            snapshot = self._read_edi_snapshot(
+                cr, uid, deposit, context=context)
+        for picking, address, packages in snapshot:
+            # TODO So Colissimo see correction in V7 branch
+            # dropoff_site = picking.dropoff_site_id
+            non_machi = "N"
+            # TODO
+            # if picking.non_machinable:
+            #     non_machi = "O"
+            dropoff_code = None
+            # TODO So Colissimo see correction in V7 branch
+            # if picking.to_dropoff_site:
+                # dropoff_code = dropoff_site.code
+            AR = "N"
+            if picking.carrier_code == "6C":
+                AR = "O"
+            name = address['name'].replace(' ', '`')
+            if address['title']:
+                name = address['title'].replace('.', '') + "`" + name
+            else:
+                name = "M`" + name
+            phone = self.phone_number_formating(
+                cr, uid, address['phone'], context=context)
+            mobile = self.phone_number_formating(
+                cr, uid, address['mobile'], context=context)
+            phone, mobile = self._coliposte_default_phone(
+                cr, uid, phone, mobile, context=context)
+            if not phone and not mobile and not address['email']:
+                raise orm.except_orm(
+                    u'Information manquante sur %s' % picking.name,
+                    u"L'un des champs suivant ne doit pas être vide:\n"
+                    u"mobile, phone, email\n"
+                    u"(sous peine de surtaxation de La Poste)")
+            country_code = address['country_code'] or ''
+            for pack in packages:
+                sequence = pack['parcel_tracking'][2:-1]
+                weight = int(pack['weight']*1000)
                 # TODO So Colissimo see correction in V7 branch
-                # if picking.to_dropoff_site:
-                    # dropoff_code = dropoff_site.code
-                AR = "N"
-                if picking.carrier_code == "6C":
-                    AR = "O"
-                name = address.name.replace(' ', '`')
-                if address.title:
-                    name = address.title.shortcut.replace('.', '') + "`" + name
-                else:
-                    name = "M`" + name
-                phone = self.phone_number_formating(
-                    cr, uid, address.phone, context=context)
-                mobile = self.phone_number_formating(
-                    cr, uid, address.mobile, context=context)
-                phone, mobile = self._coliposte_default_phone(
-                    cr, uid, phone, mobile, context=context)
-                if not phone and not mobile and not address.email:
-                    raise orm.except_orm(
-                        u'Information manquante sur %s' % picking.name,
-                        u"L'un des champs suivant ne doit pas être vide:\n"
-                        u"mobile, phone, email\n"
-                        u"(sous peine de surtaxation de La Poste)")
-                country_code = ''
-                if address.country_id:
-                    country_code = address.country_id.code
-                    #import pdb;pdb.set_trace()
-                #for pack in picking._get_packages_from_picking(picking):
-                for pack in picking._get_packages_from_picking():
-                    sequence = pack.parcel_tracking[2:-1]
-                    weight = int(pack.weight*1000)
-                    # TODO So Colissimo see correction in V7 branch
-                    barcode_routage = ''
-                    # if picking.coliss_barcode_routage:
-                    #     cab_label = pick.c_barcode_routage.replace(' ', '')[1:]
-                    #     cab_content = pick.c_barcode_routage.replace(' ','')[:-1]
-                    #     barcode_routage = "%s`%s`%s`%s`%s" % (
-                    #         dropoff_site.lot_routing,
-                    #         dropoff_site.distri_sort,
-                    #         dropoff_site.version_plan,
-                    #         cab_label,
-                    #         cab_content
-                    #     )
-                    vals = {
-                        "Type d'enregistrement": "DDD001",
-                        "Code produit": picking.carrier_code,
-                        "Numéro du colis": sequence,
-                        "Poids du colis": weight,
-                        "Code postal de livraison": address.zip,
-                        "Contre-remboursement": 0,
-                        "Devise Contre remboursement": "EUR",
-                        "Assurance Ad Valorem": 0,
-                        "Devise assurance": "EUR",
-                        "Livraison Samedi": "O",
-                        "Non Mécanisable": non_machi,
-                        "Nom du destinataire": name,
-                        "Raison sociale": "",
-                        "Première ligne d’adresse": "",
-                        "Seconde ligne d'adresse": "",
-                        "Troisième ligne d'adresse": address.street,
-                        "Quatrième ligne d’adresse": "",
-                        "Code postal du destinataire": address.zip,
-                        "Commune du destinataire": address.city,
-                        "Commentaire 1": "",
-                        "Information de routage": barcode_routage,
-                        "Code Pays Destinataire": country_code,
-                        "Niveau de recommandation": "",
-                        "Accusé réception": AR,
-                        "Type de TRI Colis": "NON",
-                        "Franc de taxe et de droit": "N",
-                        "Identifiant Colissimo du destinataire": '',
-                        "Téléphone": phone,
-                        "Courriel": self._coliposte_default_mail(
-                            cr, uid, address.email, context=context),
-                        "Téléphone portable": mobile,
-                        "Code avoir/promotion": "",
-                        "Type Alerte Destinataire": "",
-                    }
-                    vals.update(
-                        self._complete_edi_lines(
-                            cr, uid, picking, deposit, address, dropoff_code,
-                            context=context)
-                    )
-                    lines.append(vals)
-        return lines
+                barcode_routage = ''
+                # if picking.coliss_barcode_routage:
+                #     cab_label = pick.c_barcode_routage.replace(' ', '')[1:]
+                #     cab_content = pick.c_barcode_routage.replace(' ','')[:-1]
+                #     barcode_routage = "%s`%s`%s`%s`%s" % (
+                #         dropoff_site.lot_routing,
+                #         dropoff_site.distri_sort,
+                #         dropoff_site.version_plan,
+                #         cab_label,
+                #         cab_content
+                #     )
+                vals = {
+                    "Type d'enregistrement": "DDD001",
+                    "Code produit": picking.carrier_code,
+                    "Numéro du colis": sequence,
+                    "Poids du colis": weight,
+                    "Code postal de livraison": address['zip'],
+                    "Contre-remboursement": 0,
+                    "Devise Contre remboursement": "EUR",
+                    "Assurance Ad Valorem": 0,
+                    "Devise assurance": "EUR",
+                    "Livraison Samedi": "O",
+                    "Non Mécanisable": non_machi,
+                    "Nom du destinataire": name,
+                    "Raison sociale": "",
+                    "Première ligne d’adresse": "",
+                    "Seconde ligne d'adresse": "",
+                    "Troisième ligne d'adresse": address['street'],
+                    "Quatrième ligne d’adresse": "",
+                    "Code postal du destinataire": address['zip'],
+                    "Commune du destinataire": address['city'],
+                    "Commentaire 1": "",
+                    "Information de routage": barcode_routage,
+                    "Code Pays Destinataire": country_code,
+                    "Niveau de recommandation": "",
+                    "Accusé réception": AR,
+                    "Type de TRI Colis": "NON",
+                    "Franc de taxe et de droit": "N",
+                    "Identifiant Colissimo du destinataire": '',
+                    "Téléphone": phone,
+                    "Courriel": self._coliposte_default_mail(
+                        cr, uid, address['email'], context=context),
+                    "Téléphone portable": mobile,
+                    "Code avoir/promotion": "",
+                    "Type Alerte Destinataire": "",
+                }
+                vals.update(
+                    self._complete_edi_lines(
+                        cr, uid, picking, deposit,
+                        partner_obj.browse(cr, uid, address['id'],
+                                           context=context),
+                        dropoff_code, context=context)
+                )
+                yield vals
 
     def _complete_edi_lines(self, cr, uid, picking, deposit, address,
                             dropoff_code, context=None):
@@ -193,39 +336,28 @@ class DepositSlip(orm.Model):
             }
         return values
 
-    def create_csv(self, cr, uid, header, lines, context=None):
+    def create_csv(self, cr, uid, header, lines, f=None, context=None):
+        """ Write the EDI file to the file object f
+
+        :return: content of the file when f is missing, True otherwise
+        """
+        if f is not None:
+            return self.write_csv(cr, uid, header, lines, f, context=context)
         f = StringIO()
-        b = unicodecsv.DictWriter(f, [
-            "Type d'enregistrement", "Identifiant du bordereau",
-            "Identifiant du client", "Date expédition",
-            "Date d'émission du bordereau", "Version Format Fichier",
-            "Site Prise en charge", "Nom commercial"],
-            dialect=LaposteDialect, encoding='ISO-8859-1')
-        b.writerow(header)
-        w = unicodecsv.DictWriter(f, [
-            "Type d'enregistrement", "Code produit", "Numéro du colis",
-            "Poids du colis", "Code postal de livraison",
-            "Contre-remboursement", "Devise Contre remboursement",
-            "Assurance Ad Valorem", "Devise assurance", "Livraison Samedi",
-            "Non Mécanisable", "Nom du destinataire", "Raison sociale",
-            "Première ligne d’adresse", "Seconde ligne d'adresse",
-            "Troisième ligne d'adresse", "Quatrième ligne d’adresse",
-            "Code postal du destinataire", "Commune du destinataire",
-            "Référence chargeur", "Code porte", "Code porte 2", "Interphone",
-            "Commentaire 1", "Information de routage",
-            "Code Pays Destinataire", "Niveau de recommandation",
-            "Accusé réception", "Type de TRI Colis",
-            "Franc de taxe et de droit",
-            "Identifiant Colissimo du destinataire", "Téléphone", "Courriel",
-            "Téléphone portable", "Identifiant du point de retrait",
-            "Code avoir/promotion", "Type Alerte Destinataire"],
-            dialect=LaposteDialect, encoding='ISO-8859-1')
-        for line in lines:
-            w.writerow(line)
+        self.write_csv(cr, uid, header, lines, f, context=context)
         f.seek(0)
         datas = f.read()
         return datas
 
+    def write_csv(self, cr, uid, header, lines, f, context=None):
+        """ Write the EDI file to the file object f,
+            lines may be an iterator: they are written as they come
+        """
+        f.write(HEADER_ENCODER.encode_dict(header))
+        for line in lines:
+            f.write(LINE_ENCODER.encode_dict(line))
+        return True
+
     def prepare_doc_vals(self, cr, uid, deposit, name, datas, context=None):
         task = deposit.picking_ids[0].company_id.colipostefr_repo_task_id
         if not task:
@@ -244,31 +376,192 @@ class DepositSlip(orm.Model):
                 }
 
     def create_file_document(
-            self, cr, uid, header, lines, deposit, context=None):
+            self, cr, uid, header, lines, deposit, export_date=None,
+            context=None):
+        """ :param export_date: date of the file name, deposit creation
+                                date if missing
+        """
         document_obj = self.pool['file.document']
         company = deposit.picking_ids[0].company_id
-        create_date = datetime.strptime(deposit.create_date, serv_date_format)
+        create_date = export_date or datetime.strptime(
+            deposit.create_date, serv_date_format)
         create_date_format = datetime.strftime(create_date, "%Y%m%d.%H%M")
         name = "%s.%s" % (company.colipostefr_account, create_date_format)
-        unencrypted_string = self.create_csv(
-            cr, uid, header, lines, context=context)
-        unencrypted_datas = base64.encodestring(unencrypted_string)
+        attachment_obj = self.pool['ir.attachment']
+        if attachment_obj._storage(cr, uid, context=context) == 'file':
+            store_fname, file_size = self._write_edi_filestore(
+                cr, uid, header, lines, context=context)
+            metrics.observe('edi_bytes', file_size, buckets=EDI_BYTES,
+                            carrier_type=deposit.carrier_type)
+            vals = self.prepare_doc_vals(
+                cr, uid, deposit, name, False, context=context)
+            del vals['datas']
+            vals['store_fname'] = store_fname
+            document_id = document_obj.create(cr, uid, vals, context=context)
+            # ir.attachment ignores the file_size given to create()
+            attachment_field = document_obj._inherits['ir.attachment']
+            attachment_id = document_obj.read(
+                cr, uid, document_id, [attachment_field], context=context,
+                load='_classic_write')[attachment_field]
+            cr.execute("UPDATE ir_attachment SET file_size=%s WHERE id=%s",
+                       (file_size, attachment_id))
+            document_obj.invalidate_cache(
+                cr, uid, ['file_size'], [document_id], context=context)
+            return document_id
+        with TemporaryFile() as csv_file, TemporaryFile() as b64_file:
+            self.create_csv(cr, uid, header, lines, f=csv_file,
+                            context=context)
+            metrics.observe('edi_bytes', csv_file.tell(), buckets=EDI_BYTES,
+                            carrier_type=deposit.carrier_type)
+            csv_file.seek(0)
+            encodestring_file(csv_file, b64_file)
+            b64_file.seek(0)
+            # stored in the database: the ORM needs the whole value
+            unencrypted_datas = b64_file.read()
         vals = self.prepare_doc_vals(
             cr, uid, deposit, name, unencrypted_datas, context=context)
         document_id = document_obj.create(cr, uid, vals, context=context)
         return document_id
 
+    def _write_edi_filestore(self, cr, uid, header, lines, context=None):
+        """ Write the EDI file straight to the filestore, under the name
+            ir.attachment gives to a content (sha1), without loading it
+            in memory
+
+        :return: tuple (store_fname, file size)
+        """
+        attachment_obj = self.pool['ir.attachment']
+        root = attachment_obj._full_path(cr, uid, '')
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        with NamedTemporaryFile(dir=root, prefix='edi.',
+                                delete=False) as tmp_file:
+            csv_file = HashingFile(tmp_file)
+            try:
+                self.create_csv(cr, uid, header, lines, f=csv_file,
+                                context=context)
+            except Exception:
+                os.unlink(tmp_file.name)
+                raise
+        sha = csv_file.sha.hexdigest()
+        store_fname = sha[:3] + '/' + sha
+        full_path = attachment_obj._full_path(cr, uid, store_fname)
+        if os.path.exists(full_path):
+            # same content already stored
+            os.unlink(tmp_file.name)
+        else:
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            os.rename(tmp_file.name, full_path)
+        return store_fname, csv_file.size
+
+    def _export_edi(self, cr, uid, deposit, delta=False, context=None):
+        """ Create the EDI file of the deposit and mark its packages
+            with the number of this export
+
+        :param delta: only export the packages which were not exported
+                      by a previous file of the deposit
+        :return: id of the file.document, False if there is no package
+        """
+        snapshot = self._read_edi_snapshot(
+            cr, uid, deposit, delta=delta, context=context)
+        package_ids = [pack['id'] for picking, address, packages in snapshot
+                       for pack in packages]
+        if not package_ids:
+            return False
+        header = self.create_header_vals(cr, uid, deposit, context=context)
+        lines = self.create_edi_lines(
+            cr, uid, deposit, snapshot=snapshot, context=context)
+        # a delta file must not have the name of the first file
+        export_date = datetime.now() if delta else None
+        document_id = self.create_file_document(
+            cr, uid, header, lines, deposit, export_date=export_date,
+            context=context)
+        metrics.observe('edi_rows', len(package_ids), buckets=EDI_ROWS,
+                        carrier_type=deposit.carrier_type)
+        export_number = deposit.colipostefr_edi_export_count + 1
+        self.pool['stock.quant.package'].write(
+            cr, uid, package_ids, {'colipostefr_edi_export': export_number},
+            context=context)
+        self.write(cr, uid, deposit.id,
+                   {'colipostefr_edi_export_count': export_number},
+                   context=context)
+        return document_id
+
     def create_edi_file(self, cr, uid, ids, context=None):
         document_ids = []
         for deposit in self.browse(cr, uid, ids, context=context):
             if not deposit.picking_ids:
                 continue
             if deposit.carrier_type in ('colissimo', 'so_colissimo'):
-                header = self.create_header_vals(
-                    cr, uid, deposit, context=context)
-                lines = self.create_edi_lines(
-                    cr, uid, deposit, context=context)
-                if lines:
-                    document_ids = self.create_file_document(
-                        cr, uid, header, lines, deposit, context=context)
+                document_ids = self._export_edi(
+                    cr, uid, deposit, context=context) or document_ids
         return document_ids
+
+    def create_edi_delta_file(self, cr, uid, ids, context=None):
+        """ Create EDI files with only the packages added to the deposits
+            since their last EDI file
+        """
+        document_ids = []
+        for deposit in self.browse(cr, uid, ids, context=context):
+            if not deposit.picking_ids:
+                continue
+            if deposit.carrier_type in ('colissimo', 'so_colissimo'):
+                document_id = self._export_edi(
+                    cr, uid, deposit, delta=True, context=context)
+                if document_id:
+                    document_ids.append(document_id)
+        return document_ids
+
+    def _create_edi_file_in_new_cursor(self, dbname, uid, deposit_id,
+                                       context=None):
+        """ Create the EDI file of a deposit in its own transaction
+
+        :return: tuple (deposit_id, document ids, error message)
+        """
+        threading.current_thread().dbname = dbname
+        try:
+            with api.Environment.manage():
+                with openerp.registry(dbname).cursor() as cr:
+                    document_ids = self.create_edi_file(
+                        cr, uid, [deposit_id], context=context)
+        except Exception as e:
+            _logger.exception("EDI file of deposit %s failed", deposit_id)
+            message = e.value if isinstance(e, orm.except_orm) else e
+            return (deposit_id, [], ustr(message))
+        if not isinstance(document_ids, list):
+            document_ids = [document_ids]
+        return (deposit_id, document_ids, None)
+
+    def create_edi_files(self, cr, uid, ids, context=None):
+        """ Create the EDI files of several deposits in parallel
+
+        Each deposit is processed in its own thread, cursor and committed
+        transaction (the server option 'colipostefr_edi_workers' gives
+        the number of threads, 4 by default): the deposits must be
+        committed before, and a failing deposit doesn't prevent
+        the files of the other ones to be created.
+
+        :return: dict {'document_ids': list of all the created documents,
+                       'errors': {deposit_id: error message}}
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        size = min(int(config.get('colipostefr_edi_workers', 4)), len(ids))
+        result = {'document_ids': [], 'errors': {}}
+        if not size:
+            return result
+        pool = ThreadPool(size)
+        try:
+            outputs = pool.map(
+                lambda deposit_id: self._create_edi_file_in_new_cursor(
+                    cr.dbname, uid, deposit_id, context=context),
+                ids)
+        finally:
+            pool.close()
+            pool.join()
+        for deposit_id, document_ids, error in outputs:
+            result['document_ids'].extend(document_ids)
+            if error:
+                result['errors'][deposit_id] = error
+        return result
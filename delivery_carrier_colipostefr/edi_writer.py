@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author Benoît GUILLOT <benoit.guillot@akretion.com>
+#
+##############################################################################
+
+""" Positional encoder of the La Poste EDI records
+
+Produces the same bytes as unicodecsv.DictWriter with LaposteDialect,
+without building a dict writer, nor looking up each field by name
+at write time.
+Run this file to compare both writers.
+"""
+
+import re
+from csv import Dialect
+from _csv import QUOTE_MINIMAL
+
+
+class LaposteDialect(Dialect):
+    """Describe the usual properties of Excel-generated CSV files."""
+    delimiter = ';'
+    quotechar = '"'
+    escapechar = '\\'
+    doublequote = False
+    skipinitialspace = False
+    lineterminator = '\r\n'
+    quoting = QUOTE_MINIMAL
+
+
+HEADER_COLUMNS = (
+    "Type d'enregistrement", "Identifiant du bordereau",
+    "Identifiant du client", "Date expédition",
+    "Date d'émission du bordereau", "Version Format Fichier",
+    "Site Prise en charge", "Nom commercial")
+
+LINE_COLUMNS = (
+    "Type d'enregistrement", "Code produit", "Numéro du colis",
+    "Poids du colis", "Code postal de livraison",
+    "Contre-remboursement", "Devise Contre remboursement",
+    "Assurance Ad Valorem", "Devise assurance", "Livraison Samedi",
+    "Non Mécanisable", "Nom du destinataire", "Raison sociale",
+    "Première ligne d’adresse", "Seconde ligne d'adresse",
+    "Troisième ligne d'adresse", "Quatrième ligne d’adresse",
+    "Code postal du destinataire", "Commune du destinataire",
+    "Référence chargeur", "Code porte", "Code porte 2", "Interphone",
+    "Commentaire 1", "Information de routage",
+    "Code Pays Destinataire", "Niveau de recommandation",
+    "Accusé réception", "Type de TRI Colis",
+    "Franc de taxe et de droit",
+    "Identifiant Colissimo du destinataire", "Téléphone", "Courriel",
+    "Téléphone portable", "Identifiant du point de retrait",
+    "Code avoir/promotion", "Type Alerte Destinataire")
+
+
+class RowEncoder(object):
+    """ Encode rows given as tuples, in the order of columns,
+        following the rules of the csv module for the dialect
+        (QUOTE_MINIMAL and no double quote only)
+    """
+
+    def __init__(self, columns, dialect=LaposteDialect,
+                 encoding='ISO-8859-1'):
+        self.columns = tuple(columns)
+        self.encoding = encoding
+        self.delimiter = dialect.delimiter
+        self.quotechar = dialect.quotechar
+        self.escaped_quotechar = dialect.escapechar + dialect.quotechar
+        self.lineterminator = dialect.lineterminator
+        # characters which make a field quoted
+        self.needs_quotes = re.compile('[%s]' % re.escape(
+            dialect.delimiter + dialect.escapechar
+            + dialect.lineterminator)).search
+
+    def encode_field(self, value):
+        if value.__class__ is not str:
+            if isinstance(value, unicode):
+                value = value.encode(self.encoding)
+            elif value is None:
+                return ''
+            elif isinstance(value, float):
+                return repr(value)
+            else:
+                return str(value)
+        if self.quotechar in value:
+            if self.needs_quotes(value):
+                return '%s%s%s' % (
+                    self.quotechar,
+                    value.replace(self.quotechar, self.escaped_quotechar),
+                    self.quotechar)
+            return value.replace(self.quotechar, self.escaped_quotechar)
+        if self.needs_quotes(value):
+            return '%s%s%s' % (self.quotechar, value, self.quotechar)
+        return value
+
+    def encode(self, row):
+        fields = map(self.encode_field, row)
+        if len(fields) == 1 and fields[0] == '':
+            fields[0] = self.quotechar * 2
+        return self.delimiter.join(fields) + self.lineterminator
+
+    def encode_dict(self, vals):
+        """ Encode a dict keyed by column, missing columns are empty """
+        get = vals.get
+        return self.encode([get(column, '') for column in self.columns])
+
+
+HEADER_ENCODER = RowEncoder(HEADER_COLUMNS)
+LINE_ENCODER = RowEncoder(LINE_COLUMNS)
+
+
+if __name__ == '__main__':
+    from cStringIO import StringIO
+    from timeit import timeit
+    import unicodecsv
+
+    line = dict.fromkeys(LINE_COLUMNS, "")
+    line.update({
+        "Type d'enregistrement": "DDD001",
+        "Code produit": "9L",
+        "Numéro du colis": "0012345678",
+        "Poids du colis": 1250,
+        "Code postal de livraison": u"69001",
+        "Contre-remboursement": 0,
+        "Nom du destinataire": u"M`Éric`Dupont",
+        "Troisième ligne d'adresse": u'3 rue du Pré "Bas"',
+        "Commune du destinataire": u"Lyon",
+        "Courriel": u"eric@example.com",
+        "Téléphone portable": u"0600000000",
+    })
+    rows = 20000
+
+    def dict_writer():
+        f = StringIO()
+        writer = unicodecsv.DictWriter(f, LINE_COLUMNS,
+                                       dialect=LaposteDialect,
+                                       encoding='ISO-8859-1')
+        for i in xrange(rows):
+            writer.writerow(line)
+        return f.getvalue()
+
+    def row_encoder():
+        f = StringIO()
+        for i in xrange(rows):
+            f.write(LINE_ENCODER.encode_dict(line))
+        return f.getvalue()
+
+    assert dict_writer() == row_encoder()
+    for func in (dict_writer, row_encoder):
+        duration = timeit(func, number=5) / 5
+        print '%-12s %8d rows/s' % (func.__name__, rows / duration)
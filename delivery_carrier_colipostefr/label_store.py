@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+import hashlib
+from datetime import datetime, timedelta
+
+from openerp import SUPERUSER_ID
+from openerp.osv import orm, fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from openerp.tools.config import config
+
+
+def label_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class ColipostefrLabel(orm.Model):
+    """ Labels received from La Poste, before the printer profile
+        moves their fields.
+        The labels of a package are printed again from this store,
+        without calling La Poste, only by the reprint action of the
+        picking and as long as its tracking number is unchanged.
+        Labels are kept 'colipostefr_label_retention_days' days
+        (server option, 90 by default).
+        Technical model: only used through the methods below.
+    """
+    _name = 'colipostefr.label'
+    _description = 'ColiPoste Label Store'
+    _order = 'id desc'
+
+    _columns = {
+        'package_id': fields.many2one(
+            'stock.quant.package', 'Package', required=True,
+            ondelete='cascade', select=True),
+        'parcel_tracking': fields.char(
+            'Parcel Tracking', required=True, select=True),
+        'content_hash': fields.char(
+            'Content Hash', size=40, required=True),
+        'carrier_code': fields.char('Carrier Code', size=4),
+        'cab_suivi': fields.char('Tracking Barcode'),
+        'cab_prise_en_charge': fields.char('Pick-up Barcode'),
+        'zpl': fields.text('ZPL'),
+    }
+
+    _sql_constraints = [
+        ('label_uniq', 'unique(package_id, parcel_tracking, content_hash)',
+         'This label is already stored for the package.'),
+    ]
+
+    def store_label(self, cr, uid, package_id, carrier_code, cab_suivi,
+                    cab_prise_en_charge, zpl, context=None):
+        """ Keep the label of the package, a label already stored
+            with the same tracking number and content is not duplicated
+        """
+        vals = {
+            'package_id': package_id,
+            'parcel_tracking': cab_suivi.replace(' ', ''),
+            'content_hash': label_hash(zpl),
+        }
+        label_ids = self.search(
+            cr, SUPERUSER_ID, [(key, '=', value)
+                               for key, value in vals.items()],
+            context=context)
+        if label_ids:
+            return label_ids[0]
+        vals.update({
+            'carrier_code': carrier_code,
+            'cab_suivi': cab_suivi,
+            'cab_prise_en_charge': cab_prise_en_charge,
+            'zpl': zpl,
+        })
+        return self.create(cr, SUPERUSER_ID, vals, context=context)
+
+    def get_stored_labels(self, cr, uid, package_ids, carrier_code,
+                          context=None):
+        """ Last label stored for the current tracking number
+            of the packages
+
+        :return: dict {package_id: {'zpl', 'cab_suivi',
+                                    'cab_prise_en_charge'}}
+        """
+        if not package_ids:
+            return {}
+        cr.execute("""
+            SELECT DISTINCT ON (l.package_id)
+                l.package_id, l.zpl, l.cab_suivi, l.cab_prise_en_charge
+            FROM colipostefr_label l
+                JOIN stock_quant_package p
+                    ON p.id = l.package_id
+                    AND p.parcel_tracking = l.parcel_tracking
+            WHERE l.package_id IN %s
+                AND l.carrier_code = %s
+            ORDER BY l.package_id, l.id DESC
+            """, (tuple(package_ids), carrier_code))
+        return dict((package_id, {
+            'zpl': zpl,
+            'cab_suivi': cab_suivi,
+            'cab_prise_en_charge': cab_prise_en_charge,
+        }) for package_id, zpl, cab_suivi, cab_prise_en_charge
+            in cr.fetchall())
+
+    def purge_labels(self, cr, uid, context=None):
+        """ Delete the labels older than the retention period,
+            called by a scheduled action
+        """
+        days = int(config.get('colipostefr_label_retention_days', 90))
+        limit = (datetime.now() - timedelta(days=days)).strftime(
+            DEFAULT_SERVER_DATETIME_FORMAT)
+        label_ids = self.search(
+            cr, SUPERUSER_ID, [('create_date', '<', limit)], context=context)
+        self.unlink(cr, SUPERUSER_ID, label_ids, context=context)
+        return True
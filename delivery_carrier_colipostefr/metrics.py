@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+""" Timing of the stages of the label generation, counters and histograms
+
+    with metrics.span('sequences', carrier_code='9L', company=1):
+        ...
+    metrics.increment('labels', 3, carrier_code='9L')
+    metrics.observe('edi_rows', 1200, carrier_type='colissimo')
+
+The durations are given to the recorder chosen by the server option
+'colipostefr_metrics' (log, memory or statsd, none by default),
+another recorder may be set with set_recorder(). The statsd recorder
+also pushes the counters and histograms to the collector.
+
+Counters and histograms (span durations included) are kept in REGISTRY,
+rendered in the Prometheus text format by the /colipostefr/metrics
+route when the server option 'colipostefr_metrics_endpoint' is set.
+REGISTRY is kept by each worker: with several workers, push them to
+a collector with the statsd recorder.
+"""
+
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from openerp.tools.config import config
+
+_logger = logging.getLogger(__name__)
+
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in labels)
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """ Counters and histograms of the worker """
+
+    def __init__(self, prefix='colipostefr'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # {name: {labels: value}}
+        self.counters = {}
+        # {name: (buckets, {labels: [bucket counts, sum, count]})}
+        self.histograms = {}
+
+    def increment(self, name, value, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, labels, buckets=None):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = (tuple(buckets or DEFAULT_BUCKETS),
+                                         {})
+            buckets, series = self.histograms[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(buckets), 0, 0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """ Prometheus text format (version 0.0.4) """
+        lines = []
+        with self.lock:
+            for name, counter in sorted(self.counters.items()):
+                metric = '%s_%s_total' % (self.prefix, name)
+                lines.append('# TYPE %s counter' % metric)
+                for labels, value in sorted(counter.items()):
+                    lines.append('%s%s %s' % (
+                        metric, _format_labels(labels),
+                        _format_number(value)))
+            for name, (buckets, series) in sorted(self.histograms.items()):
+                metric = '%s_%s' % (self.prefix, name)
+                lines.append('# TYPE %s histogram' % metric)
+                for labels, (counts, total, count) in sorted(series.items()):
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append('%s_bucket%s %s' % (
+                            metric, _format_labels(
+                                labels, [('le', _format_number(bound))]),
+                            bucket_count))
+                    lines.append('%s_bucket%s %s' % (
+                        metric, _format_labels(labels, [('le', '+Inf')]),
+                        count))
+                    lines.append('%s_sum%s %s' % (
+                        metric, _format_labels(labels),
+                        _format_number(total)))
+                    lines.append('%s_count%s %s' % (
+                        metric, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class NullRecorder(object):
+
+    def record(self, name, duration, tags):
+        pass
+
+    def increment(self, name, value, tags):
+        pass
+
+    def observe(self, name, value, tags):
+        pass
+
+
+class LogRecorder(NullRecorder):
+    """ Log each duration (debug level) """
+
+    def record(self, name, duration, tags):
+        _logger.debug("%s %s: %.3fms", name,
+                      ' '.join('%s=%s' % tag for tag in sorted(tags.items())),
+                      duration * 1000)
+
+
+class MemoryRecorder(NullRecorder):
+    """ Aggregate the durations of the worker by name and tags """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {(name, tags): [count, total, min, max]}
+        self.spans = {}
+
+    def record(self, name, duration, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            span = self.spans.get(key)
+            if span is None:
+                self.spans[key] = [1, duration, duration, duration]
+            else:
+                span[0] += 1
+                span[1] += duration
+                span[2] = min(span[2], duration)
+                span[3] = max(span[3], duration)
+
+    def snapshot(self, reset=False):
+        """ :return: list of dicts name, tags, count, total, min, max """
+        with self.lock:
+            spans = self.spans.items()
+            if reset:
+                self.spans = {}
+        return [{'name': name, 'tags': dict(tags), 'count': count,
+                 'total': total, 'min': min_, 'max': max_}
+                for (name, tags), (count, total, min_, max_) in spans]
+
+
+class StatsdRecorder(NullRecorder):
+    """ Send each duration as a StatsD timer to a local collector,
+        counters and histograms too, with DogStatsD tags
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='colipostefr'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, metric_type, tags):
+        packet = '%s.%s:%s|%s' % (self.prefix, name, value, metric_type)
+        if tags:
+            packet += '|#' + ','.join(
+                '%s:%s' % tag for tag in sorted(tags.items()))
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            # metrics must never break the label generation
+            _logger.debug("Can't send %s to StatsD", packet, exc_info=True)
+
+    def record(self, name, duration, tags):
+        self.send(name, '%.3f' % (duration * 1000), 'ms', tags)
+
+    def increment(self, name, value, tags):
+        self.send(name, value, 'c', tags)
+
+    def observe(self, name, value, tags):
+        self.send(name, value, 'h', tags)
+
+
+_recorder = None
+
+
+def set_recorder(recorder):
+    global _recorder
+    _recorder = recorder
+
+
+def get_recorder():
+    global _recorder
+    if _recorder is None:
+        kind = config.get('colipostefr_metrics')
+        if kind == 'log':
+            _recorder = LogRecorder()
+        elif kind == 'memory':
+            _recorder = MemoryRecorder()
+        elif kind == 'statsd':
+            _recorder = StatsdRecorder(
+                config.get('colipostefr_statsd_host', 'localhost'),
+                config.get('colipostefr_statsd_port', 8125))
+        else:
+            _recorder = NullRecorder()
+    return _recorder
+
+
+@contextmanager
+def span(name, **tags):
+    """ Record the duration of the block, even when it raises """
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        get_recorder().record(name, duration, tags)
+        labels = dict(tags, stage=name)
+        REGISTRY.observe('stage_seconds', duration, labels)
+
+
+def increment(name, value=1, **tags):
+    REGISTRY.increment(name, value, tags)
+    get_recorder().increment(name, value, tags)
+
+
+def observe(name, value, buckets=None, **tags):
+    REGISTRY.observe(name, value, tags, buckets=buckets)
+    get_recorder().observe(name, value, tags)
+
+
+def record_webservice_attempt(account, attempt, duration, error):
+    """ Listener of webservice.attempt_listeners """
+    outcome = 'ok' if error is None else error.__class__.__name__
+    observe('webservice_seconds', duration, outcome=outcome,
+            retry=attempt > 0 and 'yes' or 'no')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+import logging
+import threading
+from collections import deque
+
+import openerp
+from openerp.osv import orm, fields
+from openerp.tools.config import config
+from openerp.tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+# numbers reserved in advance by this worker {(dbname, seq_id): deque}
+_reserved = {}
+# one lock by reserved pool {(dbname, seq_id): Lock}
+_reserved_locks = {}
+_reserved_locks_lock = threading.Lock()
+
+
+def _get_reserved_lock(key):
+    with _reserved_locks_lock:
+        return _reserved_locks.setdefault(key, threading.Lock())
+
+
+class IrSequence(orm.Model):
+    _inherit = 'ir.sequence'
+
+    _columns = {
+        'colipostefr_number_max': fields.integer(
+            'Max Number (La Poste)',
+            help="Dernier numéro de la plage attribuée par La Poste.\n"
+                 "0 : pas de limite"),
+    }
+
+    def _get_colipostefr_sequence(self, cr, uid, code, context=None):
+        """ Same sequence selection as next_by_code() """
+        if context is None:
+            context = {}
+        company_ids = self.pool['res.company'].search(
+            cr, uid, [], context=context) + [False]
+        ids = self.search(cr, uid, ['&', ('code', '=', code),
+                                    ('company_id', 'in', company_ids)],
+                          context=context)
+        if not ids:
+            return False
+        force_company = context.get('force_company')
+        if not force_company:
+            force_company = self.pool['res.users'].browse(
+                cr, uid, uid, context=context).company_id.id
+        sequences = self.read(
+            cr, uid, ids, ['name', 'company_id', 'implementation', 'prefix',
+                           'suffix', 'padding', 'number_increment',
+                           'colipostefr_number_max'],
+            context=context)
+        preferred = [seq for seq in sequences
+                     if seq['company_id']
+                     and seq['company_id'][0] == force_company]
+        return preferred[0] if preferred else sequences[0]
+
+    def _allocate_colipostefr_numbers(self, cr, uid, seq, quantity,
+                                      minimum=None, context=None):
+        """ Consume `quantity` numbers of the sequence, fewer when the
+            La Poste range ends before but at least `minimum`
+            (`quantity` by default).
+            The range is checked before anything is consumed.
+        """
+        if minimum is None:
+            minimum = quantity
+        if seq['implementation'] == 'standard':
+            # nextval() can't be rolled back: check the range first
+            increment = seq['number_increment']
+            cr.execute("SELECT last_value, is_called "
+                       "FROM ir_sequence_%03d" % seq['id'])
+            last_value, is_called = cr.fetchone()
+            number_next = last_value + increment if is_called else last_value
+        else:
+            cr.execute("SELECT number_next, number_increment "
+                       "FROM ir_sequence "
+                       "WHERE id=%s FOR UPDATE NOWAIT", (seq['id'],))
+            number_next, increment = cr.fetchone()
+        number_max = seq['colipostefr_number_max']
+        if number_max and increment > 0:
+            left = max((number_max - number_next) // increment + 1, 0)
+            quantity = min(quantity, max(left, minimum))
+        self._check_colipostefr_range(
+            seq, number_next + (quantity - 1) * increment)
+        if seq['implementation'] == 'standard':
+            cr.execute("SELECT nextval('ir_sequence_%03d') "
+                       "FROM generate_series(1, %%s)" % seq['id'],
+                       (quantity,))
+            numbers = [row[0] for row in cr.fetchall()]
+            # next_by_code() may have consumed numbers in the meantime
+            self._check_colipostefr_range(seq, numbers[-1])
+            return numbers
+        numbers = [number_next + i * increment for i in range(quantity)]
+        cr.execute("UPDATE ir_sequence "
+                   "SET number_next=number_next + %s "
+                   "WHERE id=%s ", (quantity * increment, seq['id']))
+        self.invalidate_cache(cr, uid, ['number_next'], [seq['id']],
+                              context=context)
+        return numbers
+
+    def _check_colipostefr_range(self, seq, last_number):
+        number_max = seq['colipostefr_number_max']
+        if number_max and last_number > number_max:
+            raise orm.except_orm(
+                _("Picking sequence"),
+                _("The range of the sequence '%s' given by La Poste "
+                  "is exhausted (max %s).\nAsk La Poste for a new range.")
+                % (seq['name'], number_max))
+        if number_max and number_max - last_number < 100:
+            _logger.warning("Sequence '%s': only %s numbers left in the "
+                            "La Poste range", seq['name'],
+                            number_max - last_number)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(IrSequence, self).write(
+            cr, uid, ids, vals, context=context)
+        if set(vals) & set(['number_next', 'number_increment',
+                            'implementation', 'colipostefr_number_max']):
+            # reserved numbers may be out of the new range: the pools
+            # of every worker are dropped with the caches
+            self.clear_caches()
+        return res
+
+    def clear_caches(self):
+        """ Drop the numbers reserved by the worker too """
+        with _reserved_locks_lock:
+            for key in _reserved.keys():
+                if key[0] == self.pool.db_name:
+                    del _reserved[key]
+        return super(IrSequence, self).clear_caches()
+
+    def _take_reserved_numbers(self, cr, uid, seq, quantity, context=None):
+        """ Take numbers from the worker's reserved pool, refilled
+            in a separate committed transaction: numbers handed out are
+            never reused, even if the current transaction is rolled back
+        """
+        refill = config.get('colipostefr_sequence_pool_size', 0)
+        key = (cr.dbname, seq['id'])
+        with _get_reserved_lock(key):
+            pool = _reserved.setdefault(key, deque())
+            if len(pool) < quantity:
+                # the refill stops at the end of the La Poste range
+                needed = quantity - len(pool)
+                with openerp.registry(cr.dbname).cursor() as new_cr:
+                    pool.extend(self._allocate_colipostefr_numbers(
+                        new_cr, uid, seq, max(int(refill), needed),
+                        minimum=needed, context=context))
+            return [pool.popleft() for i in range(quantity)]
+
+    def reserve_colipostefr_numbers(self, cr, uid, code, quantity,
+                                    context=None):
+        """ Reserve a block of `quantity` numbers of the sequence `code`
+
+        When the server option 'colipostefr_sequence_pool_size' is set,
+        numbers are taken from a pool reserved in advance by the worker
+        and refilled by blocks of this size.
+
+        :return: list of formatted sequences, False if there is no sequence
+        """
+        seq = self._get_colipostefr_sequence(cr, uid, code, context=context)
+        if not seq:
+            return False
+        if config.get('colipostefr_sequence_pool_size'):
+            numbers = self._take_reserved_numbers(
+                cr, uid, seq, quantity, context=context)
+        else:
+            numbers = self._allocate_colipostefr_numbers(
+                cr, uid, seq, quantity, context=context)
+        d = self._interpolation_dict()
+        try:
+            prefix = self._interpolate(seq['prefix'], d)
+            suffix = self._interpolate(seq['suffix'], d)
+        except ValueError:
+            raise orm.except_orm(
+                _('Warning'),
+                _('Invalid prefix or suffix for sequence \'%s\'')
+                % seq['name'])
+        return [prefix + '%%0%sd' % seq['padding'] % number + suffix
+                for number in numbers]
@@ -8,10 +8,13 @@
 #          Sébastien BEAU
 ##############################################################################
 
+import logging
+
+from openerp import tools
 from openerp.osv import orm, fields
 from openerp.tools.config import config
 from openerp.tools.translate import _
-from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT, ustr
 from laposte_api.colissimo_and_so import (
     ColiPoste,
     InvalidDataForMako,
@@ -28,10 +31,34 @@ from laposte_api.exception_helper import (
     InvalidKeyInTemplate,
     InvalidType)
 
+from collections import OrderedDict
 from datetime import datetime
 
+from . import metrics
+from . import webservice
+from . import zpl
+
+_logger = logging.getLogger(__name__)
+
 EXCEPT_TITLE = "'Colissimo and So' library Exception"
 LABEL_TYPE = 'zpl2'
+# carrier codes using the international web service
+INTERNATIONAL_CODES = ['EI', 'AI', 'SO']
+
+
+webservice.attempt_listeners.append(metrics.record_webservice_attempt)
+
+
+def count_error(exception):
+    """ Count the library errors by class (see metrics) """
+    metrics.increment('errors', exception=exception.__class__.__name__)
+
+
+def error_message(exception):
+    """ Message of an error of the label batch """
+    if isinstance(exception, orm.except_orm):
+        return exception.value
+    return ustr(exception)
 
 
 def raise_exception(orm, message):
@@ -90,15 +117,11 @@ def move_label_content(content, tag, value, axis='y'):
     return content.replace(tag, new_tag)
 
 
-def modify_label_content(content):
-    """ International web service label is too long
-        to be printed correctly
+def modify_label_content(content, carrier_code='EI', profile='default'):
+    """ Move label content according to the carrier code
+        and the printer profile (see zpl.LABEL_OFFSETS)
     """
-    tags = ['^FO270,920', '^FO30,920', '^FO670,920', '^FO290,970',
-            '^FO27,995', '^FO170,1194', '^FO27,988']
-    for tag in tags:
-        content = move_label_content(content, tag, -30)
-    return content
+    return zpl.get_transformer(carrier_code, profile)(content)
 
 
 class StockPicking(orm.Model):
@@ -106,7 +129,7 @@ class StockPicking(orm.Model):
 
     def send_douane_doc(self, cr, uid, ids, field_n, arg, context=None):
         result = {}
-        for elm in self.browse(cr, uid, ids):
+        for elm in self.browse(cr, uid, ids, context=context):
             res = False
             if elm.state == 'done' and elm.carrier_type == 'colissimo':
                 eu_country = False
@@ -125,6 +148,45 @@ class StockPicking(orm.Model):
             result[elm.id] = res
         return result
 
+    def _get_pickings_from_self(self, cr, uid, ids, context=None):
+        return ids
+
+    def _get_pickings_from_partner(self, cr, uid, ids, context=None):
+        return self.pool['stock.picking'].search(
+            cr, uid, [('partner_id', 'in', ids)], context=context)
+
+    def _get_pickings_from_country(self, cr, uid, ids, context=None):
+        return self.pool['stock.picking'].search(
+            cr, uid, [('partner_id.country_id', 'in', ids)], context=context)
+
+    def _get_pickings_from_carrier(self, cr, uid, ids, context=None):
+        return self.pool['stock.picking'].search(
+            cr, uid, [('carrier_id', 'in', ids)], context=context)
+
+    def _get_pickings_from_moves(self, cr, uid, ids, context=None):
+        picking_ids = set()
+        for move in self.pool['stock.move'].read(
+                cr, uid, ids, ['picking_id'], context=context,
+                load='_classic_write'):
+            if move['picking_id']:
+                picking_ids.add(move['picking_id'])
+        return list(picking_ids)
+
+    _douane_doc_store = {
+        'stock.picking': (
+            _get_pickings_from_self,
+            ['state', 'carrier_id', 'carrier_type', 'carrier_code',
+             'partner_id'], 10),
+        'res.partner': (_get_pickings_from_partner, ['country_id'], 10),
+        'res.country': (_get_pickings_from_country,
+                        ['intrastat', 'code'], 10),
+        'delivery.carrier': (_get_pickings_from_carrier,
+                             ['type', 'code'], 10),
+        # the state of the picking is stored from its moves,
+        # after the state itself (priority 20)
+        'stock.move': (_get_pickings_from_moves, ['state', 'picking_id'], 30),
+    }
+
     _columns = {
         'colipostefr_prise_en_charge': fields.char(
             '||| || |||| pch',
@@ -158,7 +220,8 @@ class StockPicking(orm.Model):
             send_douane_doc,
             string='Send douane document',
             type='boolean',
-            store=False,
+            store=_douane_doc_store,
+            select=True,
             help="Define if document CN23 et CN11 should be "
                  "printed/sent with the parcel"),
     }
@@ -187,9 +250,11 @@ class StockPicking(orm.Model):
             option['insurance'] = pick.colipostefr_insur_recomm
         return option
 
-    def _prepare_sender_postefr(self, cr, uid, pick, context=None):
-        partner = self.pool['stock.picking']._get_label_sender_address(
-            cr, uid, pick.id, context=context)
+    def _prepare_sender_postefr(self, cr, uid, pick, partner=None,
+                                context=None):
+        if partner is None:
+            partner = self.pool['stock.picking']._get_label_sender_address(
+                cr, uid, pick.id, context=context)
         sender = {'support_city': pick.company_id.colipostefr_support_city,
                   'password': pick.company_id.colipostefr_password}
         if partner.country_id:
@@ -222,24 +287,42 @@ class StockPicking(orm.Model):
         }
         return delivery
 
+    def _get_packages_weight(self, cr, uid, package_ids, context=None):
+        """ Compute the weight of packages in a single query:
+            products weight * quantities of the pack operations
+            + weight of the logistic unit
+
+        :return: dict {package_id: weight}
+        """
+        if not package_ids:
+            return {}
+        cr.execute("""
+            SELECT pack.id,
+                   COALESCE(ul.weight, 0)
+                   + COALESCE(SUM(tmpl.weight * op.product_qty), 0)
+            FROM stock_quant_package pack
+            LEFT JOIN product_ul ul ON ul.id = pack.ul_id
+            LEFT JOIN stock_pack_operation op
+                ON op.result_package_id = pack.id
+            LEFT JOIN product_product prod ON prod.id = op.product_id
+            LEFT JOIN product_template tmpl
+                ON tmpl.id = prod.product_tmpl_id
+            WHERE pack.id IN %s
+            GROUP BY pack.id, ul.weight
+            """, (tuple(package_ids),))
+        return dict(cr.fetchall())
+
     def _prepare_pack_postefr(
             self, cr, uid, packing, picking, option, service, france,
-            weight=None, context=None):
-        pack_op_obj = self.pool['stock.pack.operation']
-        # compute weight
-        weight = 0
-        pack_op_ids = pack_op_obj.search(
-            cr, uid, [('result_package_id', '=', packing.id)],
-            context=context)
-        for pack_op in pack_op_obj.browse(
-                cr, uid, pack_op_ids, context=context):
-            weight += pack_op.product_id.weight * pack_op.product_qty
-        if packing.ul_id:
-            weight += packing.ul_id.weight
+            weight=None, sequence=None, context=None):
+        if weight is None:
+            with metrics.span('weights', **self._get_metric_tags(picking)):
+                weight = self._get_packages_weight(
+                    cr, uid, [packing.id], context=context)[packing.id]
         pack = {'weight': weight}
         if france:
             # we do not call webservice to get these infos
-            pack['sequence'] = self._get_sequence(
+            pack['sequence'] = sequence or self._get_sequence(
                 cr, uid, picking.carrier_code, context=context)
             pack['cab_suivi'] = service.get_cab_suivi(
                 pack['sequence'])
@@ -251,75 +334,314 @@ class StockPicking(orm.Model):
 
     def _generate_coliposte_label(
             self, cr, uid, picking, service, sender, address, france, option,
-            package_ids=None, context=None):
-        """ Generate labels and write package numbers received """
+            package_ids=None, weights=None, sequences=None,
+            stored_labels=None, pending_ids=None, context=None):
+        """ Generate labels and write package numbers received
+
+        Each package is a checkpoint: a package whose label can't be
+        generated is marked as failed and the labels of the other
+        packages are kept. Generating the labels of the picking again
+        only requests the labels still missing.
+        The error is raised when no label at all could be generated.
+
+        :param weights: dict {package_id: weight}, computed if missing
+        :param sequences: sequences reserved for the packages (France only)
+                          without stored label, reserved here if missing
+        :param stored_labels: labels of the label store printed again
+                              instead of calling La Poste,
+                              read here if missing
+        :param pending_ids: packages to label among package_ids,
+                            all of them if missing
+        """
         pack_number = 0
-        carrier = {}
-        deliv = {}
         labels = []
-        tracking_refs = []
+        tags = self._get_metric_tags(picking)
         if package_ids is None:
             package_ids = self._get_packages_from_picking(
                 cr, uid, picking.id, context=context)
+        if pending_ids is None:
+            pending_ids = package_ids
+        if weights is None:
+            with metrics.span('weights', **tags):
+                weights = self._get_packages_weight(
+                    cr, uid, pending_ids, context=context)
+        if stored_labels is None:
+            stored_labels = self._get_stored_labels(
+                cr, uid, picking.carrier_code, pending_ids, context=context)
+        if france and sequences is None:
+            with metrics.span('sequences', **tags):
+                sequences = self._get_sequences(
+                    cr, uid, picking.carrier_code,
+                    len(set(pending_ids) - set(stored_labels)),
+                    context=context)
+        sequences = list(sequences or [])
         delivery = self._prepare_delivery_postefr(
             cr, uid, picking, len(package_ids), context=context)
+        profile = self._get_label_printer_profile(
+            cr, uid, picking, context=context)
+        errors = OrderedDict()
+        packs = []
         for packing in self.pool['stock.quant.package'].browse(
                 cr, uid, package_ids, context=context):
             pack_number += 1
+            if packing.id not in pending_ids:
+                continue
             addr = address.copy()
-            deliv.clear()
             deliv = delivery.copy()
-            label_info = {
-                'file_type': LABEL_TYPE,
-            }
-            pack = self._prepare_pack_postefr(
-                cr, uid, packing, picking, option, service, france,
-                context=context)
+            stored = stored_labels.get(packing.id)
+            if stored:
+                pack = {
+                    'weight': weights[packing.id],
+                    'cab_suivi': stored['cab_suivi'],
+                    'cab_prise_en_charge': stored['cab_prise_en_charge'],
+                }
+            else:
+                sequence = sequences and sequences.pop(0) or None
+                try:
+                    with cr.savepoint():
+                        pack = self._prepare_pack_postefr(
+                            cr, uid, packing, picking, option, service,
+                            france, weight=weights[packing.id],
+                            sequence=sequence, context=context)
+                except orm.except_orm as e:
+                    errors[packing.id] = e
+                    continue
             pack['name'] = packing.name
             deliv.update(pack)
             deliv['ref_client'] = deliv['ref_client'].replace(
                 'pack_number', str(pack_number))
-            # get label
-            label = self.get_zpl(service, sender, deliv, addr, option)
+            packs.append((packing, pack, deliv, addr, stored))
+        # get labels of the packages missing in the label store
+        zpls = iter(self._get_zpls(
+            cr, uid, picking, service, sender, option, france,
+            list((deliv, addr) for packing, pack, deliv, addr, stored
+                 in packs if not stored),
+            context=context))
+        packages_vals = {}
+        messages = []
+        for packing, pack, deliv, addr, stored in packs:
+            if stored:
+                label = stored['zpl']
+                if picking.carrier_code in INTERNATIONAL_CODES:
+                    label = (label, [], stored['cab_suivi'],
+                             stored['cab_prise_en_charge'])
+            else:
+                label, error = next(zpls)
+                if error:
+                    errors[packing.id] = error
+                    continue
+            label_info = {
+                'file_type': LABEL_TYPE,
+            }
             filename = deliv['ref_client'].replace('/', '_')
             label_info.update({
                 'name': '%s.zpl' % filename,
                 'package_id': packing.id,
             })
-            # allow to record a new test unit based on picking datas
-            if picking.company_id.colipostefr_unittest_helper and france:
-                test_id = self._get_xmlid(cr, uid, picking.id) or 'no_value'
-                service._set_unit_test_file_name(
-                    test_id, pack['sequence'], pack['cab_suivi'],
-                    pack['cab_prise_en_charge'])
-            if picking.carrier_code in ['EI', 'AI', 'SO']:
-                label_info['file'] = modify_label_content(label[0])
-                pack['cab_suivi'] = label[2]
-                pack['cab_prise_en_charge'] = label[3]
-                self.write(cr, uid, [picking.id], carrier)
-                picking = self.browse(cr, uid, picking.id, context=context)
-                if label[1]:
-                    self._create_comment(cr, uid, picking, label[1],
-                                         context=context)
-            else:
-                label_info['file'] = label
+            try:
+                with cr.savepoint():
+                    # allow to record a new test unit based on picking datas
+                    if picking.company_id.colipostefr_unittest_helper \
+                            and france and not stored:
+                        test_id = self._get_xmlid(
+                            cr, uid, picking.id) or 'no_value'
+                        service._set_unit_test_file_name(
+                            test_id, pack['sequence'], pack['cab_suivi'],
+                            pack['cab_prise_en_charge'])
+                    if picking.carrier_code in INTERNATIONAL_CODES:
+                        zpl_content = label[0]
+                        label_info['file'] = modify_label_content(
+                            label[0], picking.carrier_code, profile)
+                        pack['cab_suivi'] = label[2]
+                        pack['cab_prise_en_charge'] = label[3]
+                    else:
+                        zpl_content = label
+                        label_info['file'] = label
+                    if not stored:
+                        self.pool['colipostefr.label'].store_label(
+                            cr, uid, packing.id, picking.carrier_code,
+                            pack['cab_suivi'], pack['cab_prise_en_charge'],
+                            zpl_content, context=context)
+            except orm.except_orm as e:
+                errors[packing.id] = e
+                continue
+            if picking.carrier_code in INTERNATIONAL_CODES and label[1]:
+                messages.extend(label[1])
             labels.append(label_info)
-            pack_vals = {
+            packages_vals[packing.id] = {
                 'weight': pack['weight'],
                 'parcel_tracking': pack['cab_suivi'].replace(' ', ''),
+                'colipostefr_label_state': 'done',
+                'colipostefr_label_error': False,
+            }
+        if errors and not labels:
+            raise errors.values()[0]
+        for package_id, error in errors.items():
+            packages_vals[package_id] = {
+                'colipostefr_label_state': 'failed',
+                'colipostefr_label_error': error.value,
             }
-            self.pool['stock.quant.package'].write(
-                cr, uid, packing.id, pack_vals, context=context)
-            tracking_refs.append(pack['cab_suivi'])
         pick_vals = {
             'number_of_packages': len(package_ids),
             'carrier_tracking_ref': 'see in packages',
         }
-        self.write(cr, uid, picking.id, pick_vals, context=context)
-        picking = self.browse(cr, uid, picking.id, context=context)
+        with metrics.span('write_results', **tags):
+            self._write_postefr_results(
+                cr, uid, picking, packages_vals, pick_vals, context=context)
+        if messages:
+            with metrics.span('create_comment', **tags):
+                self._create_comment(
+                    cr, uid, picking, messages, context=context)
+        if errors:
+            self._post_label_errors(cr, uid, picking, errors, context=context)
+            metrics.increment('label_errors', len(errors), **tags)
+        metrics.increment('labels', len(labels), **tags)
+        if stored_labels:
+            metrics.increment(
+                'labels_from_store',
+                sum(1 for packing, pack, deliv, addr, stored in packs
+                    if stored), **tags)
         self._customize_postefr_picking(cr, uid, picking, context=context)
         return labels
 
+    def _post_label_errors(self, cr, uid, picking, errors, context=None):
+        """ Tell on the picking which packages have no label
+
+        :param errors: dict {package_id: except_orm}
+        """
+        packages = self.pool['stock.quant.package'].browse(
+            cr, uid, errors.keys(), context=context)
+        message = ''.join(
+            '<li>%s: %s</li>\n' % (package.name, errors[package.id].value)
+            for package in packages)
+        vals = {
+            'res_id': picking.id,
+            'model': 'stock.picking',
+            'body': _("Labels missing, generate the labels again to "
+                      "retry these packages<ul>%s</ul>") % message,
+            'type': 'comment',
+        }
+        self.pool['mail.message'].create(cr, uid, vals, context=context)
+        return True
+
+    def _get_postefr_pending_packages(self, cr, uid, pick, package_ids=None,
+                                      context=None):
+        """ Packages still waiting for their label when some labels
+            of the picking were already generated
+
+        :return: None if the picking has no label yet
+        """
+        label_ids = self.pool['shipping.label'].search(
+            cr, uid, [('res_id', '=', pick.id),
+                      ('res_model', '=', 'stock.picking'),
+                      ], context=context)
+        if not label_ids:
+            return None
+        if package_ids is None:
+            package_ids = self._get_packages_from_picking(
+                cr, uid, pick.id, context=context)
+        return self.pool['stock.quant.package'].search(
+            cr, uid, [('id', 'in', package_ids),
+                      ('colipostefr_label_state', '!=', 'done')],
+            context=context)
+
+    def _get_stored_labels(self, cr, uid, carrier_code, package_ids,
+                           context=None):
+        """ Labels of the label store to print again, only when
+            'colipostefr_reprint_labels' is in the context (reprint
+            action): otherwise La Poste is called for every package,
+            the picking data may have changed since the last labels
+        """
+        if context is None:
+            context = {}
+        if not context.get('colipostefr_reprint_labels'):
+            return {}
+        return self.pool['colipostefr.label'].get_stored_labels(
+            cr, uid, package_ids, carrier_code, context=context)
+
+    def reprint_colipostefr_labels(self, cr, uid, ids, context=None):
+        """ Print again the labels of the pickings from the label store,
+            without asking La Poste new labels: use it when the
+            addresses, sender and options are unchanged since the labels
+            were generated. The packages missing in the store are
+            labelled as usual.
+        """
+        if isinstance(ids, (long, int)):
+            ids = [ids]
+        label_obj = self.pool['shipping.label']
+        label_ids = label_obj.search(
+            cr, uid, [('res_id', 'in', ids),
+                      ('res_model', '=', 'stock.picking')], context=context)
+        label_obj.unlink(cr, uid, label_ids, context=context)
+        ctx = dict(context or {}, colipostefr_reprint_labels=True)
+        return self.generate_labels(cr, uid, ids, context=ctx)
+
+    def _write_postefr_results(self, cr, uid, picking, packages_vals,
+                               pick_vals, context=None):
+        """ Write the packages and the picking once all the labels
+            of the picking are received, one write by package:
+            their tracking numbers differ.
+
+        :param packages_vals: dict {package_id: vals}
+        """
+        package_obj = self.pool['stock.quant.package']
+        for package_id, vals in packages_vals.items():
+            package_obj.write(cr, uid, package_id, vals, context=context)
+        self.write(cr, uid, picking.id, pick_vals, context=context)
+        return True
+
+    def _get_label_printer_profile(self, cr, uid, picking, context=None):
+        """ Printer profile used to move the label content,
+            override to choose it according to your printers
+        """
+        if context is None:
+            context = {}
+        return context.get('colipostefr_printer_profile', 'default')
+
+    def _get_zpls(self, cr, uid, picking, service, sender, option, france,
+                  requests, context=None):
+        """ Call the web service for each (delivery, address) of requests.
+            International calls are sent in parallel when the company
+            allows several simultaneous calls: only get_zpl() runs in
+            the worker threads, the cursor is not shared with them.
+
+        :return: list of (label, except_orm or None) in the order
+                 of requests
+        """
+        concurrency = 1
+        if not france:
+            concurrency = picking.company_id.colipostefr_ws_concurrency or 1
+        account = self._get_account(cr, uid, picking, france, context=context)
+        tags = self._get_metric_tags(picking)
+
+        def get_zpl(*args):
+            with metrics.span('get_zpl', **tags):
+                return self._get_zpl_or_error(*args)
+        with metrics.span('get_zpls', **tags):
+            return webservice.map_calls(
+                get_zpl,
+                [(service, sender, deliv, addr, option, account)
+                 for deliv, addr in requests],
+                account, concurrency)
+
+    def _get_metric_tags(self, picking):
+        """ Tags of the timings of the label generation (see metrics) """
+        return {
+            'carrier_code': picking.carrier_code,
+            'company': picking.company_id.id,
+        }
+
+    def _get_zpl_or_error(self, service, sender, delivery, address, option,
+                          account=None):
+        """ get_zpl() returning its error instead of raising it:
+            the other packages of the picking are still labelled
+        """
+        try:
+            return self.get_zpl(service, sender, delivery, address,
+                                option, account=account), None
+        except orm.except_orm as e:
+            return None, e
+
     def _get_tracking_refs(self, cr, uid, picking, context=None):
         tracking_refs = []
         for pack in self._get_packages_from_picking(
@@ -328,9 +650,21 @@ class StockPicking(orm.Model):
                 tracking_refs.append(pack.parcel_tracking)
         return tracking_refs
 
-    def get_zpl(self, service, sender, delivery, address, option):
+    def get_zpl(self, service, sender, delivery, address, option,
+                account=None):
+        """ Call the web service through webservice.call():
+            transient errors are retried and the calls stop for a while
+            when La Poste is down for the account
+            (see the server options colipostefr_ws_*)
+        """
         try:
-            result = service.get_label(sender, delivery, address, option)
+            result = webservice.call(
+                service.get_label, (sender, delivery, address, option),
+                account or service, webservice.RetryPolicy.from_config(config))
+        except webservice.CircuitOpenError as e:
+            count_error(e)
+            raise orm.except_orm(
+                "'Colissimo and So' Library Error", str(e))
         except (InvalidMissingField,
                 InvalidDataForMako,
                 InvalidKeyInTemplate,
@@ -340,8 +674,10 @@ class StockPicking(orm.Model):
                 InvalidZipCode,
                 InvalidSequence,
                 InvalidType) as e:
+            count_error(e)
             raise_exception(orm, e.message)
         except Exception as e:
+            count_error(e)
             if config.options.get('debug_mode', False):
                 raise
             else:
@@ -353,6 +689,70 @@ class StockPicking(orm.Model):
         "Use this method to override gls picking"
         return True
 
+    def _check_postefr_picking(self, cr, uid, pick, pending_ids=False,
+                               context=None):
+        """ Raise if labels can't be generated for this picking
+
+        :param pending_ids: result of _get_postefr_pending_packages(),
+                            read here if False
+        """
+        if not pick.carrier_code:
+            raise orm.except_orm(
+                _("Carrier code missing"),
+                _("'Carrier code' is missing in '%s' delivery method"
+                  % pick.carrier_type))
+        # Check that labels don't already exist for this picking,
+        # unless some packages are still waiting for their label
+        if pending_ids is False:
+            pending_ids = self._get_postefr_pending_packages(
+                cr, uid, pick, context=context)
+        if pending_ids == []:
+            raise orm.except_orm(
+                _('Error:'),
+                _('Some labels already exist for the picking %s.\n'
+                  'Please delete the existing labels in the '
+                  'attachements of this picking and try again')
+                % pick.name)
+        if pick.carrier_code in INTERNATIONAL_CODES:
+            if not pick.partner_id.country_id \
+                    and not pick.partner_id.country_id.code:
+                raise orm.except_orm(
+                    "'Colissimo and So' Library Error",
+                    "EI/AI/BE carrier code must have "
+                    "a defined country code")
+        return True
+
+    @tools.ormcache(skiparg=3)
+    def _get_cached_postefr_service(self, cr, uid, account, carrier_type,
+                                    carrier_code):
+        """ Services are shared by all the requests and threads of the
+            worker: they must not be modified.
+            The cache is cleared when ColiPoste company settings change.
+        """
+        return ColiPoste(account).get_service(carrier_type, carrier_code)
+
+    def _get_postefr_service(self, cr, uid, pick, france, context=None):
+        try:
+            account = self._get_account(
+                cr, uid, pick, france, context=context)
+            if pick.company_id.colipostefr_unittest_helper:
+                # the helper sets the test file name on the service:
+                # never on a shared one
+                service = ColiPoste(account).get_service(
+                    pick.carrier_type, pick.carrier_code)
+            else:
+                service = self._get_cached_postefr_service(
+                    cr, uid, account, pick.carrier_type, pick.carrier_code)
+        except (InvalidSize, InvalidCode, InvalidType) as e:
+            count_error(e)
+            raise_exception(orm, e.message)
+        except Exception as e:
+            count_error(e)
+            raise orm.except_orm(
+                "'Colissimo and So' Library Error",
+                map_except_message(e.message))
+        return service
+
     def generate_shipping_labels(self, cr, uid, ids, package_ids=None,
                                  context=None):
         if isinstance(ids, (long, int)):
@@ -360,56 +760,216 @@ class StockPicking(orm.Model):
         assert len(ids) == 1
         pick = self.browse(cr, uid, ids[0], context=context)
         if pick.carrier_type in ['colissimo', 'so_colissimo']:
-            if not pick.carrier_code:
-                raise orm.except_orm(
-                    _("Carrier code missing"),
-                    _("'Carrier code' is missing in '%s' delivery method"
-                      % pick.carrier_type))
-            # Check that labels don't already exist for this picking
-            label_ids = self.pool['shipping.label'].search(
-                cr, uid, [('res_id', '=', pick.id),
-                          ('res_model', '=', 'stock.picking'),
-                          ], context=context)
-            if label_ids:
-                raise orm.except_orm(
-                    _('Error:'),
-                    _('Some labels already exist for the picking %s.\n'
-                      'Please delete the existing labels in the '
-                      'attachements of this picking and try again')
-                    % pick.name)
-            france = True
-            if pick.carrier_code in ['EI', 'AI', 'SO']:
-                france = False
-            try:
-                account = self._get_account(
-                    cr, uid, pick, france, context=context)
-                service = ColiPoste(account).get_service(
-                    pick.carrier_type, pick.carrier_code)
-            except (InvalidSize, InvalidCode, InvalidType) as e:
-                raise_exception(orm, e.message)
-            except Exception as e:
-                raise orm.except_orm(
-                    "'Colissimo and So' Library Error",
-                    map_except_message(e.message))
-            option = self._prepare_option_postefr(
-                cr, uid, pick, context=context)
-            sender = self._prepare_sender_postefr(cr, uid, pick,
-                                                  context=context)
-            address = self._prepare_address_postefr(cr, uid, pick,
-                                                    context=context)
-            if not france:
-                if not pick.partner_id.country_id \
-                        and not pick.partner_id.country_id.code:
-                    raise orm.except_orm(
-                        "'Colissimo and So' Library Error",
-                        "EI/AI/BE carrier code must have "
-                        "a defined country code")
+            self._check_postefr_picking(cr, uid, pick, context=context)
+            france = pick.carrier_code not in INTERNATIONAL_CODES
+            service = self._get_postefr_service(
+                cr, uid, pick, france, context=context)
+            tags = self._get_metric_tags(pick)
+            with metrics.span('prepare_option', **tags):
+                option = self._prepare_option_postefr(
+                    cr, uid, pick, context=context)
+            with metrics.span('prepare_sender', **tags):
+                sender = self._prepare_sender_postefr(cr, uid, pick,
+                                                      context=context)
+            with metrics.span('prepare_address', **tags):
+                address = self._prepare_address_postefr(cr, uid, pick,
+                                                        context=context)
+            pending_ids = self._get_postefr_pending_packages(
+                cr, uid, pick, package_ids=package_ids, context=context)
             return self._generate_coliposte_label(
                 cr, uid, pick, service, sender, address, france, option,
-                package_ids=package_ids, context=context)
+                package_ids=package_ids, pending_ids=pending_ids,
+                context=context)
         return super(StockPicking, self).generate_shipping_labels(
             cr, uid, ids, package_ids=package_ids, context=context)
 
+    def generate_shipping_labels_batch(self, cr, uid, ids, context=None):
+        """ Generate the labels of many pickings in one call.
+
+        ColiPoste pickings are grouped by company, carrier type and
+        carrier code: the service is built once per group and the sender
+        once per sender address of the group.
+        Other pickings are delegated to generate_shipping_labels().
+        Pickings whose labels all exist are skipped. Each picking is
+        generated in a savepoint: an error only cancels the picking
+        which raised it, it is returned instead of being raised.
+        No shipping.label attachment is created: the caller has to
+        store the labels returned.
+
+        :return: dict {'labels': {picking_id: list of labels},
+                       'errors': {picking_id: error message}}
+        """
+        if isinstance(ids, (long, int)):
+            ids = [ids]
+        labels = {}
+        errors = {}
+        groups = OrderedDict()
+        picks = self.browse(cr, uid, ids, context=context)
+        package_ids, pending_ids = self._get_postefr_batch_packages(
+            cr, uid, [pick for pick in picks
+                      if pick.carrier_type in ['colissimo', 'so_colissimo']],
+            context=context)
+        for pick in picks:
+            if pick.carrier_type in ['colissimo', 'so_colissimo']:
+                if pending_ids[pick.id] == []:
+                    # already labelled
+                    continue
+                try:
+                    self._check_postefr_picking(
+                        cr, uid, pick, pending_ids=pending_ids[pick.id],
+                        context=context)
+                except orm.except_orm as e:
+                    errors[pick.id] = e.value
+                    continue
+                key = (pick.company_id.id, pick.carrier_type,
+                       pick.carrier_code)
+                groups.setdefault(key, []).append(pick)
+            else:
+                try:
+                    with cr.savepoint():
+                        labels[pick.id] = self.generate_shipping_labels(
+                            cr, uid, [pick.id], context=context)
+                except Exception as e:
+                    _logger.exception("Labels of picking %s failed", pick.id)
+                    errors[pick.id] = error_message(e)
+        for group_picks in groups.values():
+            try:
+                with cr.savepoint():
+                    group = self._prepare_postefr_batch_group(
+                        cr, uid, group_picks, package_ids, pending_ids,
+                        context=context)
+            except Exception as e:
+                _logger.exception("Labels of pickings %s failed",
+                                  [pick.id for pick in group_picks])
+                for pick in group_picks:
+                    errors[pick.id] = error_message(e)
+                continue
+            senders = {}
+            for pick in group_picks:
+                try:
+                    with cr.savepoint():
+                        labels[pick.id] = self._generate_postefr_batch_pick(
+                            cr, uid, pick, group, senders, context=context)
+                except Exception as e:
+                    _logger.exception("Labels of picking %s failed", pick.id)
+                    errors[pick.id] = error_message(e)
+        return {'labels': labels, 'errors': errors}
+
+    def _get_postefr_batch_packages(self, cr, uid, picks, context=None):
+        """ Packages of the pickings and _get_postefr_pending_packages()
+            of each of them, with one query for all the labels
+            and one for all the packages labelled
+
+        :return: tuple (dict {picking_id: package ids},
+                        dict {picking_id: pending package ids or None})
+        """
+        label_obj = self.pool['shipping.label']
+        label_ids = label_obj.search(
+            cr, uid, [('res_id', 'in', [pick.id for pick in picks]),
+                      ('res_model', '=', 'stock.picking'),
+                      ], context=context)
+        labelled_ids = set(label['res_id'] for label in label_obj.read(
+            cr, uid, label_ids, ['res_id'], context=context))
+        package_ids = {}
+        for pick in picks:
+            package_ids[pick.id] = self._get_packages_from_picking(
+                cr, uid, pick.id, context=context)
+        done_ids = set(self.pool['stock.quant.package'].search(
+            cr, uid, [('id', 'in', [package_id
+                                    for pick_id in labelled_ids
+                                    for package_id in package_ids[pick_id]]),
+                      ('colipostefr_label_state', '=', 'done')],
+            context=context))
+        pending_ids = {}
+        for pick in picks:
+            if pick.id in labelled_ids:
+                pending_ids[pick.id] = [package_id
+                                        for package_id in package_ids[pick.id]
+                                        if package_id not in done_ids]
+            else:
+                pending_ids[pick.id] = None
+        return package_ids, pending_ids
+
+    def _prepare_postefr_batch_group(self, cr, uid, picks, package_ids,
+                                     pending_ids, context=None):
+        """ Values shared by the pickings of a group of
+            generate_shipping_labels_batch(): service, packages, weights,
+            stored labels and a block of sequences (France only)
+
+        :param package_ids: dict {picking_id: package ids}
+        :param pending_ids: dict {picking_id: pending package ids or None}
+        """
+        france = picks[0].carrier_code not in INTERNATIONAL_CODES
+        package_ids = dict((pick.id, package_ids[pick.id]) for pick in picks)
+        pending_ids = dict((pick.id, pending_ids[pick.id]
+                            if pending_ids[pick.id] is not None
+                            else package_ids[pick.id]) for pick in picks)
+        tags = self._get_metric_tags(picks[0])
+        with metrics.span('weights', **tags):
+            weights = self._get_packages_weight(
+                cr, uid, [pack_id for pack_ids in pending_ids.values()
+                          for pack_id in pack_ids], context=context)
+        stored_labels = self._get_stored_labels(
+            cr, uid, picks[0].carrier_code, weights.keys(),
+            context=context)
+        sequences = []
+        if france:
+            with metrics.span('sequences', **tags):
+                sequences = self._get_sequences(
+                    cr, uid, picks[0].carrier_code,
+                    len(set(weights) - set(stored_labels)),
+                    context=context)
+        return {
+            'france': france,
+            'service': self._get_postefr_service(
+                cr, uid, picks[0], france, context=context),
+            'package_ids': package_ids,
+            'pending_ids': pending_ids,
+            'weights': weights,
+            'stored_labels': stored_labels,
+            'sequences': sequences,
+            'tags': tags,
+        }
+
+    def _generate_postefr_batch_pick(self, cr, uid, pick, group, senders,
+                                     context=None):
+        """ Labels of a picking of generate_shipping_labels_batch()
+
+        :param group: values of _prepare_postefr_batch_group()
+        :param senders: senders of the group {partner_id: sender}
+        """
+        tags = group['tags']
+        partner = self._get_label_sender_address(
+            cr, uid, pick.id, context=context)
+        if partner.id not in senders:
+            with metrics.span('prepare_sender', **tags):
+                senders[partner.id] = self._prepare_sender_postefr(
+                    cr, uid, pick, partner=partner, context=context)
+        with metrics.span('prepare_option', **tags):
+            option = self._prepare_option_postefr(
+                cr, uid, pick, context=context)
+        with metrics.span('prepare_address', **tags):
+            address = self._prepare_address_postefr(
+                cr, uid, pick, context=context)
+        service = group['service']
+        if pick.company_id.colipostefr_unittest_helper:
+            service = self._get_postefr_service(
+                cr, uid, pick, group['france'], context=context)
+        pending_ids = group['pending_ids'][pick.id]
+        pick_sequences = None
+        if group['france']:
+            # the numbers of a picking in error are not reused
+            quantity = len(set(pending_ids) - set(group['stored_labels']))
+            pick_sequences = group['sequences'][:quantity]
+            del group['sequences'][:quantity]
+        return self._generate_coliposte_label(
+            cr, uid, pick, service, senders[partner.id], address,
+            group['france'], option,
+            package_ids=group['package_ids'][pick.id],
+            weights=group['weights'], sequences=pick_sequences,
+            stored_labels=group['stored_labels'],
+            pending_ids=pending_ids, context=context)
+
     def _filter_message(self, cr, uid, mess_type, context=None):
         """ Allow to exclude returned message according their type.
             Only used by
@@ -461,6 +1021,18 @@ class StockPicking(orm.Model):
                 _("There is no sequence defined for the label '%s'") % label)
         return sequence
 
+    def _get_sequences(self, cr, uid, label, quantity, context=None):
+        """ Reserve a block of `quantity` sequences in a single call """
+        if not quantity:
+            return []
+        sequences = self.pool['ir.sequence'].reserve_colipostefr_numbers(
+            cr, uid, 'stock.picking_' + label, quantity, context=context)
+        if not sequences:
+            raise orm.except_orm(
+                _("Picking sequence"),
+                _("There is no sequence defined for the label '%s'") % label)
+        return sequences
+
     def _barcode_prise_en_charge_generate(
             self, cr, uid, service, picking, carrier_track, weight, option,
             context=None):
@@ -498,6 +1070,41 @@ class StockPicking(orm.Model):
         return 0
 
 
+class StockQuantPackage(orm.Model):
+    _inherit = 'stock.quant.package'
+
+    _columns = {
+        'colipostefr_label_state': fields.selection([
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+        ],
+            'Label State',
+            readonly=True,
+            help="Etat de la génération de l'étiquette ColiPoste : "
+                 "seuls les colis en échec sont repris "
+                 "lors d'une nouvelle génération"),
+        'colipostefr_label_error': fields.text(
+            'Label Error',
+            readonly=True),
+        'colipostefr_edi_export': fields.integer(
+            'EDI Export',
+            readonly=True,
+            help="Number of the EDI file of the deposit which sent "
+                 "this package to La Poste (0: not sent yet)"),
+    }
+
+    def copy(self, cr, uid, id, default=None, context=None):
+        if default is None:
+            default = {}
+        default.update({
+            'colipostefr_edi_export': 0,
+            'colipostefr_label_state': False,
+            'colipostefr_label_error': False,
+        })
+        return super(StockQuantPackage, self).copy(
+            cr, uid, id, default, context=context)
+
+
 class ShippingLabel(orm.Model):
     _inherit = 'shipping.label'
 
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+""" Helpers around the calls to the La Poste web service.
+
+They don't use the ORM: they may be called from worker threads.
+"""
+
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+_logger = logging.getLogger(__name__)
+
+# {account: (size, ThreadPool)}
+_pools = {}
+_pools_lock = threading.Lock()
+
+# {account: CircuitBreaker}
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# functions called after each attempt with
+# (account, attempt, duration, exception or None)
+attempt_listeners = []
+
+# errors of the network or of an unavailable service,
+# other errors (invalid data...) are never retried
+TRANSIENT_ERRORS = (IOError, socket.error, socket.timeout)
+
+
+def get_pool(account, size):
+    """ Return the thread pool shared by the web service calls
+        of an account, (re)created when its size changes
+    """
+    with _pools_lock:
+        pool_size, pool = _pools.get(account, (None, None))
+        if pool_size != size:
+            if pool is not None:
+                pool.close()
+            pool = ThreadPool(size)
+            _pools[account] = (size, pool)
+        return pool
+
+
+def map_calls(func, args_list, account, size):
+    """ Call func(*args) for each args of args_list,
+        at most `size` calls at a time for the account.
+        Results are returned in the order of args_list,
+        the first exception raised by a call is re-raised.
+    """
+    if size <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    pool = get_pool(account, size)
+    return pool.map(lambda args: func(*args), args_list)
+
+
+class CircuitOpenError(Exception):
+    """ Raised without calling the web service while it is considered
+        down for the account
+    """
+
+    def __init__(self, account, retry_in):
+        super(CircuitOpenError, self).__init__(
+            'La Poste web service is unavailable, '
+            'next try in %d seconds' % retry_in)
+        self.account = account
+        self.retry_in = retry_in
+
+
+class CallTimeout(socket.timeout):
+    """ The web service didn't answer before the deadline """
+
+
+def _call_with_timeout(func, args, timeout):
+    """ Call func(*args) in a thread, raise CallTimeout when it doesn't
+        return within `timeout` seconds: the caller is released, the
+        hung call ends in the background
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = func(*args)
+        except Exception:
+            outcome['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise CallTimeout('La Poste web service did not answer '
+                          'in %.1f seconds' % timeout)
+    if 'error' in outcome:
+        error_type, error, traceback = outcome['error']
+        raise error_type, error, traceback
+    return outcome['result']
+
+
+class RetryPolicy(object):
+    """ How the calls to the web service are retried and when
+        the circuit breaker of an account opens
+    """
+
+    def __init__(self, retries=2, backoff=0.5, backoff_max=8.0,
+                 deadline=30.0, failure_threshold=5, reset_timeout=60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @classmethod
+    def from_config(cls, config):
+        """ Policy defined by the server options colipostefr_ws_* """
+        default = cls()
+        return cls(
+            retries=int(config.get(
+                'colipostefr_ws_retries', default.retries)),
+            backoff=float(config.get(
+                'colipostefr_ws_backoff', default.backoff)),
+            backoff_max=float(config.get(
+                'colipostefr_ws_backoff_max', default.backoff_max)),
+            deadline=float(config.get(
+                'colipostefr_ws_deadline', default.deadline)),
+            failure_threshold=int(config.get(
+                'colipostefr_ws_breaker_threshold',
+                default.failure_threshold)),
+            reset_timeout=float(config.get(
+                'colipostefr_ws_breaker_reset', default.reset_timeout)))
+
+    def delay(self, attempt):
+        """ Exponential backoff with full jitter """
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """ Fail fast after `failure_threshold` consecutive transient errors,
+        then let a single call test the service every `reset_timeout`
+        seconds until it succeeds
+    """
+
+    def __init__(self, account, failure_threshold, reset_timeout):
+        self.account = account
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.testing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.time()
+            if retry_in > 0 or self.testing:
+                raise CircuitOpenError(self.account, max(retry_in, 0))
+            # half open: this call tests the service
+            self.testing = True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                _logger.info("La Poste web service is back for %s",
+                             self.account)
+            self.failures = 0
+            self.opened_at = None
+            self.testing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.testing = False
+            if self.opened_at is not None \
+                    or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    _logger.warning(
+                        "La Poste web service unavailable for %s after %s "
+                        "errors, calls are stopped for %s seconds",
+                        self.account, self.failures, self.reset_timeout)
+                self.opened_at = time.time()
+
+
+def get_breaker(account, policy):
+    with _breakers_lock:
+        breaker = _breakers.get(account)
+        if breaker is None:
+            breaker = CircuitBreaker(account, policy.failure_threshold,
+                                     policy.reset_timeout)
+            _breakers[account] = breaker
+        return breaker
+
+
+def _notify_attempt(account, attempt, duration, error):
+    for listener in attempt_listeners:
+        try:
+            listener(account, attempt, duration, error)
+        except Exception:
+            _logger.exception("Web service attempt listener failed")
+
+
+def call(func, args, account, policy):
+    """ Call func(*args) for the account, retrying transient errors
+        with exponential backoff while the deadline of the policy allows,
+        behind the circuit breaker of the account.
+        An attempt still running at the deadline is abandoned and counted
+        as a failure by the breaker: slow calls open it too.
+    """
+    breaker = get_breaker(account, policy)
+    start = time.time()
+    attempt = 0
+    while True:
+        breaker.before_call()
+        attempt_start = time.time()
+        try:
+            if policy.deadline:
+                result = _call_with_timeout(
+                    func, args,
+                    max(policy.deadline - (attempt_start - start), 0.001))
+            else:
+                result = func(*args)
+        except TRANSIENT_ERRORS as e:
+            duration = time.time() - attempt_start
+            _notify_attempt(account, attempt, duration, e)
+            breaker.failure()
+            delay = policy.delay(attempt)
+            if attempt >= policy.retries \
+                    or time.time() + delay - start > policy.deadline:
+                raise
+            _logger.info("La Poste web service call failed (%s) after "
+                         "%.3fs, retry %s in %.3fs", e, duration,
+                         attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+        except Exception as e:
+            # the service answered: it is up
+            _notify_attempt(account, attempt, time.time() - attempt_start, e)
+            breaker.success()
+            raise
+        else:
+            duration = time.time() - attempt_start
+            _logger.debug("La Poste web service call in %.3fs (attempt %s)",
+                          duration, attempt + 1)
+            _notify_attempt(account, attempt, duration, None)
+            breaker.success()
+            return result
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+""" Move the fields of the ZPL labels returned by the web service """
+
+import re
+
+FIELD_ORIGIN = re.compile(r'\^FO(\d+),(\d+)')
+
+# International web service label is too long to be printed correctly
+INTERNATIONAL_OFFSETS = {
+    (270, 920): (0, -30),
+    (30, 920): (0, -30),
+    (670, 920): (0, -30),
+    (290, 970): (0, -30),
+    (27, 995): (0, -30),
+    (170, 1194): (0, -30),
+    (27, 988): (0, -30),
+}
+
+# {printer profile: {carrier code: {(x, y): (x offset, y offset)}}}
+# Other modules may add their own profiles and carrier codes
+LABEL_OFFSETS = {
+    'default': {
+        'EI': INTERNATIONAL_OFFSETS,
+        'AI': INTERNATIONAL_OFFSETS,
+        'SO': INTERNATIONAL_OFFSETS,
+    },
+}
+
+_transformers = {}
+
+
+class FieldOriginTransformer(object):
+    """ Apply a table of offsets to the ^FO commands of a label
+        in a single pass over the label
+    """
+
+    def __init__(self, offsets):
+        self.offsets = dict(offsets)
+
+    def _move(self, match):
+        x, y = int(match.group(1)), int(match.group(2))
+        offset = self.offsets.get((x, y))
+        if offset is None:
+            return match.group(0)
+        return '^FO%s,%s' % (x + offset[0], y + offset[1])
+
+    def __call__(self, content):
+        if not self.offsets:
+            return content
+        return FIELD_ORIGIN.sub(self._move, content)
+
+
+def get_transformer(carrier_code, profile='default'):
+    """ Return the transformer of the carrier code for the printer profile,
+        the 'default' profile is used for unknown profiles
+    """
+    key = (carrier_code, profile)
+    if key not in _transformers:
+        offsets = LABEL_OFFSETS.get(profile, LABEL_OFFSETS['default'])
+        _transformers[key] = FieldOriginTransformer(
+            offsets.get(carrier_code, {}))
+    return _transformers[key]
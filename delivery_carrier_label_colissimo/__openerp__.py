@@ -87,11 +87,6 @@ Contributors
         'report/cn23.xml',
         'stock_view.xml',
     ],
-    'external_dependencies': {
-        'python': [
-            'PIL',
-            ],
-    },
     'tests': [],
     'demo': [
         'demo/stock.picking.csv',
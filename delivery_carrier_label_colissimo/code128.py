@@ -14,10 +14,12 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE
 
-from PIL import Image
-from PIL import ImageDraw
+import re
+from itertools import count, imap
+from operator import mul
 from base64 import encodestring
-from StringIO import StringIO
+from struct import pack
+from zlib import compress, crc32
 
 # Copied from http://en.wikipedia.org/wiki/Code_128
 # Value Weights 128A    128B    128C
@@ -142,71 +144,156 @@ for charset in (CODE128A, CODE128B):
     charset[' '] = charset.pop('space')
 
 
+# Module widths (bar, space, bar...) of each code value
+PATTERNS = tuple(tuple(int(weight) for weight in WEIGHTS[value])
+                 for value in sorted(WEIGHTS))
+START_B = CODE128B['StartB']
+START_C = CODE128C['StartC']
+SWITCH_B = CODE128C['CodeB']
+SWITCH_C = CODE128B['CodeC']
+STOP = CODE128B['Stop']
+# Code C value of each pair of digits
+PAIR_CODES = dict(('%02d' % value, value) for value in range(100))
+DIGITS_OR_OTHERS = re.compile(r'(\d+)|(\D+)')
+
+
 def code128_format(data):
     """
     Generate an optimal barcode from ASCII text
     """
     text = str(data)
-    pos = 0
-    length = len(text)
-    # Start Code
-    if text[:2].isdigit() and length > 1:
-        charset = CODE128C
-        codes = [charset['StartC']]
-    else:
-        charset = CODE128B
-        codes = [charset['StartB']]
-    # Data
-    while pos < length:
-        if charset is CODE128C:
-            if text[pos:pos+2].isdigit() and length - pos > 1:
-                # Encode Code C two characters at a time
-                codes.append(int(text[pos:pos+2]))
-                pos += 2
-            else:
-                # Switch to Code B
-                codes.append(charset['CodeB'])
-                charset = CODE128B
-        elif text[pos:pos+4].isdigit() and length - pos >= 4:
-            # Switch to Code C
-            codes.append(charset['CodeC'])
-            charset = CODE128C
+    codes = []
+    code_c = None
+    # runs of digits and of other characters
+    for digits, others in DIGITS_OR_OTHERS.findall(text):
+        if digits and (len(digits) >= 4 or
+                       (code_c is None and len(digits) >= 2)):
+            if code_c is None:
+                codes.append(START_C)
+            elif not code_c:
+                # Switch to Code C
+                codes.append(SWITCH_C)
+            code_c = True
+            # Encode Code C two characters at a time
+            codes.extend(PAIR_CODES[digits[pos:pos+2]]
+                         for pos in range(0, len(digits) - 1, 2))
+            if len(digits) % 2:
+                # Switch to Code B for the last digit
+                codes.append(SWITCH_B)
+                codes.append(CODE128B[digits[-1]])
+                code_c = False
         else:
+            if code_c is None:
+                codes.append(START_B)
+            elif code_c:
+                # Switch to Code B
+                codes.append(SWITCH_B)
+            code_c = False
             # Encode Code B one character at a time
-            codes.append(charset[text[pos]])
-            pos += 1
+            codes.extend(map(CODE128B.__getitem__, digits or others))
+    if code_c is None:
+        codes.append(START_B)
     # Checksum
-    checksum = 0
-    for weight, code in enumerate(codes):
-        checksum += max(weight, 1) * code
+    checksum = codes[0] + sum(imap(mul, codes[1:], count(1)))
     codes.append(checksum % 103)
     # Stop Code
-    codes.append(charset['Stop'])
+    codes.append(STOP)
     return codes
 
 
-def code128_image(data, height=100, thickness=3, quiet_zone=True):
+def code128_format_batch(datas):
+    """ Generate the barcodes of many texts """
+    return [code128_format(data) for data in datas]
+
+
+def _png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return (pack('>I', len(data)) + chunk +
+            pack('>I', crc32(chunk) & 0xffffffff))
+
+
+_BITS_CACHE = {}
+
+
+def _bits_by_code(thickness):
+    """ Pixels ('0' black, '1' white) of each code value """
+    if thickness not in _BITS_CACHE:
+        _BITS_CACHE[thickness] = tuple(
+            ''.join(('0' if index % 2 == 0 else '1') * weight * thickness
+                    for index, weight in enumerate(pattern))
+            for pattern in PATTERNS)
+    return _BITS_CACHE[thickness]
+
+
+def code128_png(data, height=100, thickness=3, quiet_zone=True):
+    """ Render the barcode as a 1 bit PNG: a single pixel row is built
+        from the bar widths, then repeated on the whole height
+    """
     if not data[-1] == CODE128B['Stop']:
         data = code128_format(data)
-    barcode_widths = []
-    for code in data:
-        for weight in WEIGHTS[code]:
-            barcode_widths.append(int(weight) * thickness)
-    width = sum(barcode_widths)
-    x = 0
-    if quiet_zone:
-        width += 20 * thickness
-        x = 10 * thickness
-    # Monochrome Image
-    img = Image.new('1', (width, height), 1)
-    draw = ImageDraw.Draw(img)
-    draw_bar = True
-    for width in barcode_widths:
-        if draw_bar:
-            draw.rectangle(((x, 0), (x + width - 1, height)), fill=0)
-        draw_bar = not draw_bar
-        x += width
-    img_io = StringIO()
-    img.save(img_io, 'PNG')
-    img_io.seek(0)
-    return encodestring(img_io.read())
+    bits_by_code = _bits_by_code(thickness)
+    quiet = '1' * 10 * thickness if quiet_zone else ''
+    bits = quiet + ''.join([bits_by_code[code] for code in data]) + quiet
+    width = len(bits)
+    # pad the row to whole bytes
+    bits += '1' * (-width % 8)
+    row = ('%0*x' % (len(bits) // 4, int(bits, 2))).decode('hex')
+    header = pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)
+    return ''.join([
+        '\x89PNG\r\n\x1a\n',
+        _png_chunk('IHDR', header),
+        _png_chunk('IDAT', compress(('\x00' + row) * height)),
+        _png_chunk('IEND', ''),
+    ])
+
+
+def code128_image(data, height=100, thickness=3, quiet_zone=True):
+    """ Barcode as a base64 encoded PNG image """
+    return encodestring(code128_png(
+        data, height=height, thickness=thickness, quiet_zone=quiet_zone))
+
+
+def code128_image_batch(datas, height=100, thickness=3, quiet_zone=True):
+    """ Render the barcodes of many texts """
+    return [code128_image(data, height=height, thickness=thickness,
+                          quiet_zone=quiet_zone)
+            for data in datas]
+
+
+ZPL_SPECIAL_CHARS = re.compile(r'[_^~]')
+
+
+def zpl_field_data(text):
+    """ Field data for ^FH^FD: '^' and '~' would start a printer command,
+        they are sent as hexadecimal, '_' too (the ^FH indicator)
+    """
+    return ZPL_SPECIAL_CHARS.sub(
+        lambda match: '_%02X' % ord(match.group()), text)
+
+
+def code128_zpl(data, height=100, thickness=2, x=0, y=0,
+                interpretation=False):
+    """ ZPL commands of the barcode: the printer draws it itself (^BC,
+        automatic subset selection), no image is sent
+    """
+    return '^FO%s,%s^BY%s^BCN,%s,%s,N,N,A^FH^FD%s^FS' % (
+        x, y, thickness, height, 'Y' if interpretation else 'N',
+        zpl_field_data(data))
+
+
+def code128_zpl_labels(datas, height=100, thickness=2, x=20, y=20,
+                       captions=None):
+    """ One ZPL label (^XA...^XZ) per text, with an optional caption
+        printed under the barcode
+    """
+    labels = []
+    for index, data in enumerate(datas):
+        label = ['^XA', code128_zpl(data, height=height, thickness=thickness,
+                                    x=x, y=y, interpretation=True)]
+        if captions and captions[index]:
+            label.append('^FO%s,%s^A0N,30,30^FH^FD%s^FS' % (
+                x, y + height + 50, zpl_field_data(captions[index])))
+        label.append('^XZ')
+        labels.append(''.join(label))
+    return '\n'.join(labels)
+
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+""" Check and benchmark the Code128 encoder of code128.py against
+a straightforward implementation. Not imported by the module, run it
+from this directory: python code128_bench.py
+"""
+
+from timeit import repeat
+
+from code128 import (CODE128B, CODE128C, code128_format,
+                     code128_format_batch, code128_image_batch)
+
+
+def code128_format_reference(data):
+    """ Straightforward implementation of code128_format() """
+    text = str(data)
+    pos = 0
+    length = len(text)
+    # Start Code
+    if text[:2].isdigit() and length > 1:
+        charset = CODE128C
+        codes = [charset['StartC']]
+    else:
+        charset = CODE128B
+        codes = [charset['StartB']]
+    # Data
+    while pos < length:
+        if charset is CODE128C:
+            if text[pos:pos+2].isdigit() and length - pos > 1:
+                # Encode Code C two characters at a time
+                codes.append(int(text[pos:pos+2]))
+                pos += 2
+            else:
+                # Switch to Code B
+                codes.append(charset['CodeB'])
+                charset = CODE128B
+        elif text[pos:pos+4].isdigit() and length - pos >= 4:
+            # Switch to Code C
+            codes.append(charset['CodeC'])
+            charset = CODE128C
+        else:
+            # Encode Code B one character at a time
+            codes.append(charset[text[pos]])
+            pos += 1
+    # Checksum
+    checksum = 0
+    for weight, code in enumerate(codes):
+        checksum += max(weight, 1) * code
+    codes.append(checksum % 103)
+    # Stop Code
+    codes.append(charset['Stop'])
+    return codes
+
+
+if __name__ == '__main__':
+    trackings = ['9L%011d' % number for number in range(10000)]
+    trackings += ['EI%09dFR' % number for number in range(10000)]
+    assert code128_format_batch(trackings) == [
+        code128_format_reference(tracking) for tracking in trackings]
+    for func in (code128_format_reference, code128_format):
+        # best of 3
+        duration = min(repeat(
+            lambda: [func(tracking) for tracking in trackings],
+            repeat=3, number=5)) / 5
+        print '%-26s %8d barcodes/s' % (
+            func.__name__, len(trackings) / duration)
+    duration = min(repeat(
+        lambda: code128_image_batch(trackings, thickness=2),
+        repeat=3, number=1))
+    print '%-26s %8d barcodes/s' % ('code128_image', len(trackings) / duration)
@@ -8,3 +8,4 @@
 #
 ##############################################################################
 
+from . import cn23
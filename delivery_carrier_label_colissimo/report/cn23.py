@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#  @author David BEAL <david.beal@akretion.com>
+#
+##############################################################################
+
+from openerp.osv import orm
+
+CN23_REPORT = 'delivery_carrier_label_colissimo.report_tpl_coliposte_cn23'
+
+
+class ReportCn23(orm.AbstractModel):
+    """ Customs declaration CN23 of the pickings.
+        Moves, products and packages of all the pickings are read
+        at once: the template doesn't browse them.
+    """
+    _name = 'report.%s' % CN23_REPORT
+
+    def _read_cn23_moves(self, cr, uid, picking_ids, context=None):
+        move_obj = self.pool['stock.move']
+        move_ids = move_obj.search(
+            cr, uid, [('picking_id', 'in', picking_ids),
+                      ('state', '!=', 'cancel')],
+            order='picking_id, id', context=context)
+        return move_obj.read(
+            cr, uid, move_ids, ['picking_id', 'product_id', 'product_qty',
+                                'name'],
+            context=context, load='_classic_write')
+
+    def _read_cn23_products(self, cr, uid, product_ids, context=None):
+        product_obj = self.pool['product.product']
+        field_names = ['name', 'default_code', 'weight_net', 'list_price']
+        for field_name in ('intrastat_id', 'origin_country_id'):
+            if field_name in product_obj._fields:
+                field_names.append(field_name)
+        return dict((product['id'], product) for product in product_obj.read(
+            cr, uid, product_ids, field_names, context=context))
+
+    def _read_cn23_trackings(self, cr, uid, picking_ids, context=None):
+        """ :return: dict {picking_id: [tracking numbers]} """
+        if not picking_ids:
+            return {}
+        cr.execute("""
+            SELECT DISTINCT o.picking_id, p.parcel_tracking
+            FROM stock_pack_operation o
+                JOIN stock_quant_package p ON p.id = o.result_package_id
+            WHERE o.picking_id IN %s
+                AND p.parcel_tracking IS NOT NULL
+            ORDER BY o.picking_id, p.parcel_tracking
+            """, (tuple(picking_ids),))
+        trackings = {}
+        for picking_id, tracking in cr.fetchall():
+            trackings.setdefault(picking_id, []).append(tracking)
+        return trackings
+
+    def _prepare_cn23_line(self, cr, uid, move, product, context=None):
+        """ One line of the declaration, override to declare
+            the sale price instead of the public price.
+            The country of origin is the one of the product when
+            the product has one (origin_country_id), blank otherwise:
+            override to give it another way.
+        """
+        hs_code = product.get('intrastat_id')
+        origin = product.get('origin_country_id')
+        return {
+            'description': product['name'],
+            'reference': product['default_code'] or '',
+            'quantity': move['product_qty'],
+            'weight': move['product_qty'] * (product['weight_net'] or 0),
+            'value': move['product_qty'] * (product['list_price'] or 0),
+            'hs_code': hs_code and hs_code[1] or '',
+            'origin': origin and origin[1] or '',
+        }
+
+    def _prepare_cn23_docs(self, cr, uid, pickings, context=None):
+        """ :return: dict {picking_id: {'lines', 'trackings', 'weight',
+                                        'value'}}
+        """
+        picking_ids = [picking.id for picking in pickings]
+        moves = self._read_cn23_moves(cr, uid, picking_ids, context=context)
+        products = self._read_cn23_products(
+            cr, uid, list(set(move['product_id'] for move in moves)),
+            context=context)
+        trackings = self._read_cn23_trackings(
+            cr, uid, picking_ids, context=context)
+        docs = {}
+        for picking in pickings:
+            docs[picking.id] = {
+                'lines': [],
+                'trackings': trackings.get(picking.id, []),
+                'weight': 0.0,
+                'value': 0.0,
+            }
+        for move in moves:
+            doc = docs[move['picking_id']]
+            line = self._prepare_cn23_line(
+                cr, uid, move, products[move['product_id']], context=context)
+            doc['lines'].append(line)
+            doc['weight'] += line['weight']
+            doc['value'] += line['value']
+        return docs
+
+    def render_html(self, cr, uid, ids, data=None, context=None):
+        report_obj = self.pool['report']
+        pickings = self.pool['stock.picking'].browse(
+            cr, uid, ids, context=context)
+        docargs = {
+            'doc_ids': ids,
+            'doc_model': 'stock.picking',
+            'docs': pickings,
+            'cn23': self._prepare_cn23_docs(
+                cr, uid, pickings, context=context),
+        }
+        return report_obj.render(
+            cr, uid, ids, CN23_REPORT, docargs, context=context)
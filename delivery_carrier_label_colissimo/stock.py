@@ -10,13 +10,65 @@
 ##############################################################################
 
 from openerp.osv import orm
+from openerp.tools.config import config
+from openerp.tools.lru import LRU
 from openerp.tools.translate import _
-from .code128 import code128_image
+from .code128 import code128_image, code128_zpl, code128_zpl_labels
+from .report.cn23 import CN23_REPORT
+
+# number of tracking numbers whose barcodes are kept by each worker
+_barcode_cache = LRU(int(config.get('colipostefr_barcode_cache_size', 2048)))
+
+
+def render_128_barcode(tracking, height, thickness):
+    """ Rendered barcodes are kept in a LRU cache of the worker:
+        {tracking: {(height, thickness): image}}
+    """
+    sizes = _barcode_cache.get(tracking) or {}
+    if (height, thickness) not in sizes:
+        sizes = dict(sizes)
+        sizes[(height, thickness)] = code128_image(
+            tracking, height=height, thickness=thickness)
+        _barcode_cache[tracking] = sizes
+    return sizes[(height, thickness)]
 
 
 class StockPicking(orm.Model):
     _inherit = 'stock.picking'
 
+    def _get_cn23_picking_ids(self, cr, uid, ids, context=None):
+        """ Pickings of ids sent with customs documents """
+        return self.search(
+            cr, uid, [('id', 'in', ids),
+                      ('colipostefr_send_douane_doc', '=', True)],
+            order='id', context=context)
+
+    def print_cn23(self, cr, uid, ids, context=None):
+        """ Report action printing the CN23 of the pickings
+            which need it, in one document
+        """
+        picking_ids = self._get_cn23_picking_ids(
+            cr, uid, ids, context=context)
+        if not picking_ids:
+            raise orm.except_orm(
+                _('CN23'),
+                _('None of these pickings needs customs documents.'))
+        return self.pool['report'].get_action(
+            cr, uid, picking_ids, CN23_REPORT, context=context)
+
+    def get_cn23_pdf(self, cr, uid, ids, context=None):
+        """ One PDF with the CN23 of the pickings which need it,
+            e.g. to be sent to the printer by a scheduled action
+
+        :return: PDF content, False if no picking needs a CN23
+        """
+        picking_ids = self._get_cn23_picking_ids(
+            cr, uid, ids, context=context)
+        if not picking_ids:
+            return False
+        return self.pool['report'].get_pdf(
+            cr, uid, picking_ids, CN23_REPORT, context=context)
+
 # This was the code that generated the label automatically when the picking
 # is "Transfered", but it's not a good idea, because when the webservice
 # of La Poste gives an error, you have to reconfigure something and validate
@@ -44,12 +96,44 @@ class StockQuantPackage(orm.Model):
     _inherit = 'stock.quant.package'
 
     def get_128_barcode(
+            self, cr, uid, ids, height=100, thickness=2, output='png',
+            context=None):
+        """ :param output: 'png' for a base64 image,
+                           'zpl' for the ZPL commands drawing the barcode
+            :return: the barcode of the package,
+                     a dict {package_id: barcode} when several ids are given
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        res = {}
+        for package in self.read(cr, uid, ids, ['parcel_tracking'],
+                                 context=context):
+            res[package['id']] = False
+            if package['parcel_tracking']:
+                tracking = package['parcel_tracking'].replace(' ', '')
+                if output == 'zpl':
+                    res[package['id']] = code128_zpl(
+                        tracking, height=height, thickness=thickness)
+                else:
+                    res[package['id']] = render_128_barcode(
+                        tracking, height, thickness)
+        if len(ids) == 1:
+            return res[ids[0]]
+        return res
+
+    def get_128_barcode_zpl_sheet(
             self, cr, uid, ids, height=100, thickness=2, context=None):
-        assert len(ids) == 1, \
-            _('This option should only be used for a single id at a time')
-        package = self.browse(cr, uid, ids[0], context=context)
-        if package.parcel_tracking:
-            tracking = package.parcel_tracking.replace(' ', '')
-            return code128_image(tracking, height=height, thickness=thickness)
-        else:
-            return False
+        """ ZPL labels with the barcode and the name of each package,
+            packages without tracking number are skipped
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        trackings = []
+        names = []
+        for package in self.read(cr, uid, ids, ['parcel_tracking', 'name'],
+                                 context=context):
+            if package['parcel_tracking']:
+                trackings.append(package['parcel_tracking'].replace(' ', ''))
+                names.append(package['name'])
+        return code128_zpl_labels(trackings, height=height,
+                                  thickness=thickness, captions=names)
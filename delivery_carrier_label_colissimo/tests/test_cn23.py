@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#  licence AGPL version 3 or later
+#  see licence in __openerp__.py or http://www.gnu.org/licenses/agpl-3.0.txt
+#  Copyright (C) 2014 Akretion (http://www.akretion.com).
+#
+##############################################################################
+
+import openerp.tests.common as common
+
+
+class TestCn23(common.TransactionCase):
+
+    def setUp(self):
+        super(TestCn23, self).setUp()
+        self.picking_obj = self.registry('stock.picking')
+        self.product_id = self.registry('product.product').create(
+            self.cr, self.uid, {'name': 'CN23 product', 'type': 'consu',
+                                'weight_net': 0.5, 'list_price': 10.0})
+
+    def _create_picking(self, carrier_xmlid, country_xmlid):
+        cr, uid = self.cr, self.uid
+        partner_id = self.registry('res.partner').create(cr, uid, {
+            'name': 'CN23 customer',
+            'country_id': self.ref(country_xmlid),
+        })
+        return self.picking_obj.create(cr, uid, {
+            'partner_id': partner_id,
+            'carrier_id': self.ref(carrier_xmlid),
+            'picking_type_id': self.ref('stock.picking_type_out'),
+            'move_lines': [(0, 0, {
+                'name': 'CN23 product',
+                'product_id': self.product_id,
+                'product_uom_qty': 2,
+                'product_uom': self.ref('product.product_uom_unit'),
+                'location_id': self.ref('stock.stock_location_stock'),
+                'location_dest_id': self.ref(
+                    'stock.stock_location_customers'),
+            })],
+        })
+
+    def _validate(self, picking_id):
+        cr, uid = self.cr, self.uid
+        self.picking_obj.action_confirm(cr, uid, [picking_id])
+        self.picking_obj.force_assign(cr, uid, [picking_id])
+        self.picking_obj.action_done(cr, uid, [picking_id])
+        return self.picking_obj.browse(cr, uid, picking_id)
+
+    def test_douane_doc_on_validation(self):
+        """ The customs flag is stored when the picking is validated """
+        cr, uid = self.cr, self.uid
+        picking_id = self._create_picking(
+            'delivery_carrier_label_colissimo.delivery_carrier_EI',
+            'base.us')
+        picking = self.picking_obj.browse(cr, uid, picking_id)
+        self.assertFalse(picking.colipostefr_send_douane_doc)
+        picking = self._validate(picking_id)
+        self.assertEqual(picking.state, 'done')
+        self.assertTrue(picking.colipostefr_send_douane_doc)
+        self.assertEqual(
+            self.picking_obj._get_cn23_picking_ids(cr, uid, [picking_id]),
+            [picking_id])
+
+    def test_no_douane_doc_in_france(self):
+        cr, uid = self.cr, self.uid
+        picking_id = self._create_picking(
+            'delivery_carrier_label_colissimo.delivery_carrier_9L',
+            'base.fr')
+        picking = self._validate(picking_id)
+        self.assertEqual(picking.state, 'done')
+        self.assertFalse(picking.colipostefr_send_douane_doc)
+        self.assertEqual(
+            self.picking_obj._get_cn23_picking_ids(cr, uid, [picking_id]),
+            [])
+
+    def test_cn23_lines(self):
+        """ The country of origin is never the company's one """
+        cr, uid = self.cr, self.uid
+        picking_id = self._create_picking(
+            'delivery_carrier_label_colissimo.delivery_carrier_EI',
+            'base.us')
+        picking = self._validate(picking_id)
+        docs = self.registry(
+            'report.delivery_carrier_label_colissimo.'
+            'report_tpl_coliposte_cn23')._prepare_cn23_docs(
+            cr, uid, [picking])
+        lines = docs[picking_id]['lines']
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['quantity'], 2)
+        self.assertEqual(lines[0]['value'], 20.0)
+        if 'origin_country_id' not in self.registry(
+                'product.product')._fields:
+            self.assertEqual(lines[0]['origin'], '')